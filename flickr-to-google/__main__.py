@@ -4,6 +4,10 @@ import asyncio
 from parse import parser, Methods
 
 from flickr.api import init as init_flickr_api
+from flickr.query import (
+    configure_concurrency as configure_flickr_concurrency,
+    configure_rate_limit as configure_flickr_rate_limit,
+)
 from flickr.directory import create_directory
 from flickr.photos import query_photo_data
 from flickr.download import download_photos as flickr_download_photos
@@ -11,15 +15,43 @@ from flickr.download import download_photos as flickr_download_photos
 from google.authenticate import authenticate_user as authenticate_google_user
 from google.albums import create_albums
 from google.photo_upload import upload_photos as google_upload_photos
+from google.rest import (
+    configure_client as configure_google_client,
+    configure_rate_limits as configure_google_rate_limits,
+    close_client as close_google_client,
+)
 
+from common.budget import configure_byte_budget
 from common.config import Config, write_config
-from common.log import print_separator, print_timestamped
-
-OPERATION_RETRY_LIMIT = 10
+from common.request import close_clients as close_download_clients
+from common.processing import configure_process_pool, shutdown_process_pool
 
 async def run_cli():
     args = parser.parse_args()
 
+    configure_google_client(args.max_connections, args.http2)
+    configure_google_rate_limits(args.google_rate, args.google_daily_quota)
+
+    if args.flickr_rate is not None:
+        configure_flickr_rate_limit(args.flickr_rate)
+
+    if args.concurrency is not None:
+        configure_flickr_concurrency(args.concurrency)
+
+    if args.processes is not None:
+        configure_process_pool(args.processes)
+
+    if args.max_inflight_bytes is not None:
+        configure_byte_budget(args.max_inflight_bytes)
+
+    try:
+        await run_method(args)
+    finally:
+        await close_download_clients()
+        await close_google_client()
+        shutdown_process_pool()
+
+async def run_method(args):
     method = args.method
 
     if method == Methods.SET_CONFIG:
@@ -27,13 +59,15 @@ async def run_cli():
     elif method == Methods.AUTHENTICATE:
         authenticate()
     elif method == Methods.CREATE_DIRECTORY:
-        await create_directory()
+        await create_directory(args.incremental)
     elif method == Methods.POPULATE_DIRECTORY:
-        await repeated(query_photo_data)
+        await query_photo_data()
     elif method == Methods.DOWNLOAD_PHOTOS:
         await download_photos(args)
     elif method == Methods.CREATE_ALBUMS:
-        await repeated(create_albums)
+        await create_albums()
+    elif method == Methods.TRANSFER:
+        await transfer_photos(args)
     else:
         await upload_photos(args)
 
@@ -53,36 +87,29 @@ def authenticate():
     authenticate_google_user()
 
 async def download_photos(args):
-    await repeated(
-        flickr_download_photos,
+    await flickr_download_photos(
         args.path,
         args.download_all,
         args.videos_only,
+        args.concurrency,
     )
 
 async def upload_photos(args):
-    await repeated(
-        google_upload_photos,
+    await google_upload_photos(
         args.videos_only,
         args.missing_exif_only,
         args.upload_all,
+        args.concurrency,
     )
 
-async def repeated(method, *args, count=0):
-    num_succeeded, num_attempted = await method(*args)
-
-    if num_succeeded == num_attempted:
-        return
-    elif count == OPERATION_RETRY_LIMIT - 1:
-        print_retry_failure()
-        return
-    else:
-        await repeated(method, *args, count=count + 1)
-
-def print_retry_failure():
-    print_separator()
-    print_timestamped(
-        f'Did not complete after {OPERATION_RETRY_LIMIT} attempts.'
+async def transfer_photos(args):
+    # Every photo is streamed from Flickr straight into the upload, so that no disk is used.
+    await google_upload_photos(
+        args.videos_only,
+        args.missing_exif_only,
+        args.upload_all,
+        args.concurrency,
+        is_streaming=True,
     )
 
 if __name__ == '__main__':
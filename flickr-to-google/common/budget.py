@@ -0,0 +1,98 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+
+# Downloads, EXIF updates and uploads share a single budget, so that large items wait for capacity
+# rather than exhausting memory:
+MAX_INFLIGHT_BYTES = 512 * 1024 * 1024
+
+max_inflight_bytes = MAX_INFLIGHT_BYTES
+budget = None
+
+class ByteBudget:
+    """Limits the number of bytes held in-flight across concurrent tasks. Reservations are granted in
+    the order they are requested, so that large ones are not starved by a stream of small ones."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+        # Pairs of the future to resolve and the size to reserve, in the order requested:
+        self.waiters = deque()
+
+    async def acquire(self, size):
+        """Waits until `size` bytes are available and all earlier reservations are granted, then
+        reserves and returns the amount reserved. Items larger than the limit reserve the entire
+        budget, so that they run alone."""
+
+        size = min(size, self.limit)
+
+        if not self.waiters and self.used + size <= self.limit:
+            self.used += size
+            return size
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append((waiter, size))
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The reservation was granted as the task was cancelled, so it is returned.
+                self.used -= size
+            else:
+                self.waiters.remove((waiter, size))
+
+            self._grant_waiters()
+            raise
+
+        return size
+
+    async def release(self, size):
+        """Returns `size` reserved bytes to the budget."""
+
+        self.used -= size
+        self._grant_waiters()
+
+    def _grant_waiters(self):
+        """Grants reservations from the front of the queue while they fit in the budget."""
+
+        while self.waiters:
+            waiter, size = self.waiters[0]
+
+            if self.used + size > self.limit:
+                break
+
+            self.waiters.popleft()
+            self.used += size
+            waiter.set_result(None)
+
+    @asynccontextmanager
+    async def reserve(self, size):
+        """Reserves `size` bytes for the duration of the context."""
+
+        reserved = await self.acquire(size)
+
+        try:
+            yield
+        finally:
+            await self.release(reserved)
+
+def configure_byte_budget(limit):
+    """Sets the maximum number of bytes in-flight, which must be called before the budget's first use."""
+
+    global max_inflight_bytes
+
+    assert budget is None
+
+    max_inflight_bytes = limit
+
+def get_byte_budget():
+    """Returns the shared byte budget, creating it on first use."""
+
+    global budget
+
+    if budget is None:
+        budget = ByteBudget(max_inflight_bytes)
+
+    return budget
@@ -0,0 +1,32 @@
+import asyncio
+
+PROGRESS_INTERVAL = 10
+
+async def gather_bounded(coroutines, limit, progress_handler=None):
+    """Awaits `coroutines` within a sliding window of at most `limit` concurrent coroutines, and
+    returns their results in order. A new coroutine starts as soon as any other completes.
+
+    `progress_handler`, if set, is called with the list of completed results after every
+    `PROGRESS_INTERVAL` completions and once all have completed."""
+
+    pending = enumerate(coroutines)
+    results = {}
+    completed = []
+
+    async def run_worker():
+        # Workers share the iterator, so each coroutine is started exactly once.
+        for index, coroutine in pending:
+            result = await coroutine
+
+            results[index] = result
+            completed.append(result)
+
+            if progress_handler is not None and len(completed) % PROGRESS_INTERVAL == 0:
+                progress_handler(completed)
+
+    await asyncio.gather(*[run_worker() for _ in range(limit)])
+
+    if progress_handler is not None and len(completed) % PROGRESS_INTERVAL != 0:
+        progress_handler(completed)
+
+    return [results[index] for index in range(len(results))]
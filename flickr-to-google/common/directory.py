@@ -1,62 +1,433 @@
 import os
+import json
+import sqlite3
 from pathlib import Path
 
-from .files import read_json_file, write_json_file
+from .files import read_json_file
 from .config import create_path_from_base
+from .log import print_timestamped, print_separator
+
+DATABASE_FILENAME = 'directory.db'
+DATABASE_VERSION = 1
+
+# Look up photos by ID in groups of this size, within SQLite's limit on query parameters:
+ID_QUERY_BATCH_SIZE = 500
+
+# Iterate over photos in pages of this size, so that memory does not grow with the directory:
+PHOTO_PAGE_SIZE = 500
+
+PHOTOSTREAM_DIRECTORY = 'photostream'
+
+# These mirror the entry keys set by the Flickr and Google phases, and are used to derive the
+# indexed status columns on each write:
+URL_KEY = 'url'
+DOWNLOAD_FILE_PATH_KEY = 'image_path'
+DID_UPDATE_EXIF_KEY = 'did_update_exif'
+GOOGLE_MEDIA_ID_KEY = 'google-media-id'
+GOOGLE_ALBUM_ID_KEY = 'google-album-id'
+ALBUM_IDS_KEY = 'album_ids'
+GOOGLE_ADDED_ALBUM_IDS_KEY = 'google-added-album-ids'
+GOOGLE_CREATED_WITHOUT_ALBUM_KEY = 'google-created-without-album'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS albums (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    is_created INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS photos (
+    id TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    data TEXT NOT NULL,
+    is_video INTEGER NOT NULL DEFAULT 0,
+    is_populated INTEGER NOT NULL DEFAULT 0,
+    is_downloaded INTEGER NOT NULL DEFAULT 0,
+    is_uploaded INTEGER NOT NULL DEFAULT 0,
+    did_update_exif INTEGER NOT NULL DEFAULT 0,
+    is_in_albums INTEGER NOT NULL DEFAULT 1
+);
+
+CREATE INDEX IF NOT EXISTS photos_directory ON photos (directory);
+CREATE INDEX IF NOT EXISTS photos_populated ON photos (is_populated, id);
+CREATE INDEX IF NOT EXISTS photos_downloaded ON photos (is_populated, is_downloaded, id);
+CREATE INDEX IF NOT EXISTS photos_uploaded ON photos (is_populated, is_uploaded, directory, id);
+CREATE INDEX IF NOT EXISTS photos_in_albums ON photos (is_uploaded, is_in_albums);
+
+CREATE TABLE IF NOT EXISTS media (
+    hash TEXT PRIMARY KEY,
+    media_id TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS quotas (
+    name TEXT NOT NULL,
+    day TEXT NOT NULL,
+    usage INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (name, day)
+);
+"""
+
+INSERT_ALBUM = 'INSERT OR REPLACE INTO albums (id, data, is_created) VALUES (?, ?, ?)'
+
+INSERT_MEDIA = 'INSERT OR REPLACE INTO media (hash, media_id) VALUES (?, ?)'
+
+INSERT_PHOTO = """
+INSERT OR REPLACE INTO photos (
+    id,
+    directory,
+    data,
+    is_video,
+    is_populated,
+    is_downloaded,
+    is_uploaded,
+    did_update_exif,
+    is_in_albums
+) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+connection = None
+
+def get_connection():
+    """Returns the directory database connection, creating and migrating it on first use."""
+
+    global connection
+
+    if connection is None:
+        connection = _open_connection()
+
+    return connection
 
 def get_outputs_path():
-    """Returns a path to `outputs`."""
+    """Returns a path to `outputs`, the legacy JSON directory."""
 
     return create_path_from_base('outputs')
 
 def read_album_metadata(directory):
     """Returns the album metadata for the album at `directory`."""
 
-    path = get_album_metadata_path(directory)
-    return read_json_file(path)
+    row = get_connection().execute(
+        'SELECT data FROM albums WHERE id = ?',
+        (directory,),
+    ).fetchone()
+
+    if row is None:
+        raise KeyError(f'Album {directory} does not exist in the directory')
+
+    return json.loads(row['data'])
+
+def read_albums(is_created=None):
+    """Returns a list of album metadata, optionally filtered by whether the Google album exists."""
+
+    query, params = _create_filtered_query(
+        'SELECT data FROM albums',
+        is_created=is_created,
+    )
+
+    rows = get_connection().execute(query, params).fetchall()
+
+    return [json.loads(row['data']) for row in rows]
 
 def write_album_metadata(album):
-    """Writes an album metadata to the appropriate path."""
+    """Writes an album metadata entry."""
+
+    write_albums_metadata([album])
 
-    path = get_album_metadata_path(album['id'])
-    path.parent.mkdir(parents=True, exist_ok=True)
+def write_albums_metadata(albums):
+    """Writes a list of album metadata entries in a single transaction."""
 
-    write_json_file(path, album)
+    rows = [_create_album_row(album) for album in albums]
 
-def get_album_metadata_path(directory):
-    """Returns a path to the album metadata.json."""
+    with get_connection() as db:
+        db.executemany(INSERT_ALBUM, rows)
 
-    directory_path = get_directory_path(directory)
-    return Path(os.path.join(directory_path, 'metadata.json'))
+def read_photos_data(photo_ids):
+    """Returns a dictionary of `photo_id` to `(directory, photo)` entry for each of `photo_ids` that
+    exists in the directory."""
 
-def read_photo_data(directory, filename):
-    """Returns a photo data object from `directory/filename`."""
+    entries = {}
 
-    path = get_photo_data_path(directory, filename)
-    return read_json_file(path)
+    for i in range(0, len(photo_ids), ID_QUERY_BATCH_SIZE):
+        batch = photo_ids[i:i + ID_QUERY_BATCH_SIZE]
+        placeholders = ', '.join('?' * len(batch))
+
+        rows = get_connection().execute(
+            f'SELECT id, directory, data FROM photos WHERE id IN ({placeholders})',
+            batch,
+        ).fetchall()
+
+        for row in rows:
+            entries[row['id']] = (row['directory'], json.loads(row['data']))
+
+    return entries
+
+def read_photos(
+    directory=None,
+    is_video=None,
+    is_populated=None,
+    is_downloaded=None,
+    is_uploaded=None,
+    did_update_exif=None,
+    is_in_albums=None,
+):
+    """Returns a list of `(directory, photo)` entries matching the status filters, where `None`
+    matches any value."""
+
+    query, params = _create_filtered_query(
+        'SELECT directory, data FROM photos',
+        directory=directory,
+        is_video=is_video,
+        is_populated=is_populated,
+        is_downloaded=is_downloaded,
+        is_uploaded=is_uploaded,
+        did_update_exif=did_update_exif,
+        is_in_albums=is_in_albums,
+    )
+
+    rows = get_connection().execute(query, params).fetchall()
+
+    return [(row['directory'], json.loads(row['data'])) for row in rows]
+
+def iterate_photos(**filters):
+    """Yields the `(directory, photo)` entries matching the status filters accepted by `read_photos`,
+    reading a page of `PHOTO_PAGE_SIZE` entries at a time, so that work on the first entries begins
+    at once and memory stays bounded. Pages are keyed by photo ID, so entries written during
+    iteration are neither skipped nor repeated."""
+
+    query, params = _create_filtered_query('SELECT id, directory, data FROM photos', **filters)
+    query += ' AND' if len(params) > 0 else ' WHERE'
+    query += ' id > ? ORDER BY id LIMIT ?'
+
+    last_id = ''
+
+    while True:
+        rows = get_connection().execute(query, params + [last_id, PHOTO_PAGE_SIZE]).fetchall()
+
+        for row in rows:
+            yield row['directory'], json.loads(row['data'])
+
+        if len(rows) < PHOTO_PAGE_SIZE:
+            return
+
+        last_id = rows[-1]['id']
+
+def count_photos(**filters):
+    """Returns the number of photos matching the status filters accepted by `read_photos`."""
+
+    query, params = _create_filtered_query('SELECT COUNT(*) FROM photos', **filters)
+
+    return get_connection().execute(query, params).fetchone()[0]
+
+def read_directories():
+    """Returns the list of directories (album IDs and the photostream) that contain photos."""
+
+    rows = get_connection().execute('SELECT DISTINCT directory FROM photos').fetchall()
+
+    return [row['directory'] for row in rows]
 
 def write_photo_data(directory, photo):
     """Writes a photo data entry within `directory`."""
 
-    filename = get_photo_filename(photo)
-    path = get_photo_data_path(directory, filename)
-    path.parent.mkdir(parents=True, exist_ok=True)
+    write_photos_data(directory, [photo])
+
+def write_photos_data(directory, photos):
+    """Writes a list of photo data entries within `directory` in a single transaction."""
+
+    rows = [_create_photo_row(directory, photo) for photo in photos]
+
+    with get_connection() as db:
+        db.executemany(INSERT_PHOTO, rows)
+
+def get_pending_album_ids(directory, photo):
+    """Returns the list of albums that `photo` belongs to besides `directory`, which its media item
+    has not yet been added to. Items created without an album, in batches packed across directories,
+    are pending in `directory` as well."""
+
+    album_ids = photo.get(ALBUM_IDS_KEY, [])
+    added_album_ids = photo.get(GOOGLE_ADDED_ALBUM_IDS_KEY, [])
 
-    write_json_file(path, photo)
+    if photo.get(GOOGLE_CREATED_WITHOUT_ALBUM_KEY, False):
+        album_ids = list(dict.fromkeys([directory] + album_ids))
+    else:
+        album_ids = [album_id for album_id in album_ids if album_id != directory]
 
-def get_photo_data_path(directory, filename):
-    """Returns a path to the photo data entry."""
+    return [album_id for album_id in album_ids if album_id not in added_album_ids]
 
-    directory_path = get_directory_path(directory)
-    return Path(os.path.join(directory_path, filename))
+def read_media_id(digest):
+    """Returns the Google media ID of the item uploaded with the content hash `digest`, or `None` if
+    no such item has been uploaded."""
+
+    row = get_connection().execute(
+        'SELECT media_id FROM media WHERE hash = ?',
+        (digest,),
+    ).fetchone()
+
+    return None if row is None else row['media_id']
+
+def write_media_ids(media_ids):
+    """Writes a dictionary of content hash to Google media ID in a single transaction."""
+
+    with get_connection() as db:
+        db.executemany(INSERT_MEDIA, media_ids.items())
+
+def read_state(key, default=None):
+    """Returns the synchronization state value stored at `key`, or `default` if it is not set."""
+
+    row = get_connection().execute(
+        'SELECT value FROM state WHERE key = ?',
+        (key,),
+    ).fetchone()
+
+    return default if row is None else json.loads(row['value'])
+
+def write_state(key, value):
+    """Writes a synchronization state value at `key`."""
+
+    with get_connection() as db:
+        db.execute(
+            'INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)',
+            (key, json.dumps(value)),
+        )
+
+def delete_state(key):
+    """Removes the synchronization state value stored at `key`, if set."""
+
+    with get_connection() as db:
+        db.execute('DELETE FROM state WHERE key = ?', (key,))
+
+def read_quota_usage(name, day):
+    """Returns the number of requests counted against the quota `name` on `day`."""
+
+    row = get_connection().execute(
+        'SELECT usage FROM quotas WHERE name = ? AND day = ?',
+        (name, day),
+    ).fetchone()
+
+    return 0 if row is None else row['usage']
+
+def write_quota_usage(name, day, usage):
+    """Writes the number of requests counted against the quota `name` on `day`."""
+
+    with get_connection() as db:
+        db.execute(
+            'INSERT OR REPLACE INTO quotas (name, day, usage) VALUES (?, ?, ?)',
+            (name, day, usage),
+        )
 
 def get_directory_path(directory):
-    """Returns a `directory_path` by concatenating the components."""
+    """Returns a `directory_path` within the legacy JSON directory."""
 
     outputs_path = get_outputs_path()
     return Path(os.path.join(outputs_path, directory))
 
-def get_photo_filename(photo):
-    """Returns the filename corresponding to `photo`."""
+def _create_album_row(album):
+    """Returns the database row for `album`."""
+
+    return (album['id'], json.dumps(album), GOOGLE_ALBUM_ID_KEY in album)
+
+def _create_photo_row(directory, photo):
+    """Returns the database row for `photo`, deriving the status columns from its fields."""
+
+    return (
+        photo['id'],
+        directory,
+        json.dumps(photo),
+        photo.get('media', None) == 'video',
+        URL_KEY in photo,
+        DOWNLOAD_FILE_PATH_KEY in photo,
+        GOOGLE_MEDIA_ID_KEY in photo,
+        DID_UPDATE_EXIF_KEY in photo,
+        len(get_pending_album_ids(directory, photo)) == 0,
+    )
+
+def _create_filtered_query(query, **filters):
+    """Appends a `WHERE` clause for each filter that is not `None` and returns the query and its
+    parameters."""
+
+    clauses = []
+    params = []
+
+    for column, value in filters.items():
+        if value is None:
+            continue
+
+        clauses.append(f'{column} = ?')
+        params.append(value)
+
+    if len(clauses) > 0:
+        query += ' WHERE ' + ' AND '.join(clauses)
+
+    return query, params
+
+def _open_connection():
+    """Opens the database, creating the schema and migrating the JSON directory if necessary."""
+
+    path = create_path_from_base(DATABASE_FILENAME)
+
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = NORMAL')
+
+    version = db.execute('PRAGMA user_version').fetchone()[0]
+
+    if version < DATABASE_VERSION:
+        db.executescript(SCHEMA)
+        _migrate_json_directory(db)
+
+        db.execute(f'PRAGMA user_version = {DATABASE_VERSION}')
+
+    return db
+
+def _migrate_json_directory(db):
+    """Imports the legacy one-file-per-photo JSON directory, if present, into the database."""
+
+    outputs_path = get_outputs_path()
+
+    if not os.path.isdir(outputs_path):
+        return
+
+    _print_migration_init()
+
+    num_photos = 0
+
+    _, directories, _ = next(os.walk(outputs_path))
+
+    for directory in directories:
+        directory_path = get_directory_path(directory)
+        _, _, filenames = next(os.walk(directory_path))
+
+        albums = []
+        photos = []
+
+        for filename in filenames:
+            data = read_json_file(os.path.join(directory_path, filename))
+
+            if filename == 'metadata.json':
+                albums.append(data)
+            else:
+                photos.append(data)
+
+        with db:
+            db.executemany(INSERT_ALBUM, [_create_album_row(album) for album in albums])
+            db.executemany(INSERT_PHOTO, [_create_photo_row(directory, photo) for photo in photos])
+
+        num_photos += len(photos)
+
+    _print_migration_summary(num_photos)
+
+def _print_migration_init():
+    """Prints a migration initiation message."""
+
+    print_separator()
+    print_timestamped('Migrating the JSON directory to the directory database.')
+
+def _print_migration_summary(num_photos):
+    """Prints a migration summary."""
 
-    return '{}.json'.format(photo['id'])
+    print_timestamped(f'Migrated {num_photos} photo(s) to the directory database.')
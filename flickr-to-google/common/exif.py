@@ -1,7 +1,34 @@
+import os
+import shutil
+import struct
+import zlib
 import datetime
 
 from PIL import Image, ExifTags
-from io import BytesIO
+
+# Only the EXIF metadata is parsed and rewritten, by splicing it into the original byte stream, so
+# that pixel data is never decoded or re-encoded.
+
+JPEG_SIGNATURE = b'\xff\xd8'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+EXIF_HEADER = b'Exif\x00\x00'
+
+JPEG_APP0_MARKER = 0xE0
+JPEG_APP1_MARKER = 0xE1
+JPEG_COM_MARKER = 0xFE
+JPEG_MAX_SEGMENT_LENGTH = 0xFFFF
+
+PNG_EXIF_CHUNK = b'eXIf'
+PNG_DATA_CHUNKS = [b'IDAT', b'IEND']
+
+# Read this many bytes from the start of a file to locate its EXIF metadata:
+HEADER_READ_SIZE = 256 * 1024
+
+DATE_FORMAT = '%Y:%m:%d %H:%M:%S'
+
+class IncompleteHeaderError(Exception):
+    """Raised when the bytes provided end before the EXIF metadata could be located."""
 
 def updated_data_with_exif(data, photo):
     """Inserts the upload date into the EXIF metadata if a date cannot be found."""
@@ -11,59 +38,216 @@ def updated_data_with_exif(data, photo):
     if _is_media_video(photo):
         return data, did_update_exif
 
-    image = _bytes_to_image(data)
+    patch = _create_exif_patch(data, photo)
 
-    if _image_has_date(image):
+    if patch is None:
         return data, did_update_exif
 
-    exif = _get_exif(image, photo)
+    start, end, replacement = patch
 
     did_update_exif = True
 
-    return _image_to_bytes(image, exif), did_update_exif
+    return data[:start] + replacement + data[end:], did_update_exif
 
-def _bytes_to_image(data):
-    """Converts bytes to a PIL image object."""
+def updated_header_with_exif(header, photo):
+    """Inserts the upload date into the EXIF metadata within `header`, the leading bytes of a file,
+    if a date cannot be found, and returns the header and whether it was updated. Images whose EXIF
+    metadata extends beyond `header` are left unchanged, so that the rest is never buffered."""
 
-    stream = BytesIO(data)
-    image = Image.open(stream)
+    try:
+        return updated_data_with_exif(header, photo)
+    except IncompleteHeaderError:
+        return header, False
 
-    return image
+def update_file_with_exif(path, photo):
+    """Inserts the upload date into the EXIF metadata of the file at `path` if a date cannot be
+    found, and returns whether the file was updated. Only the file header is read into memory."""
 
-def _image_to_bytes(image, exif):
-    """Converts a PIL image and an EXIF dictionary to bytes."""
+    if _is_media_video(photo):
+        return False
 
-    buffer = BytesIO()
-    image.save(buffer, image.format, exif=exif.tobytes())
+    with open(path, 'rb') as file:
+        header = file.read(HEADER_READ_SIZE)
 
-    return buffer.getvalue()
+        try:
+            patch = _create_exif_patch(header, photo)
+        except IncompleteHeaderError:
+            # Fall back to the whole file for images with unusually large leading segments.
+            header += file.read()
+            patch = _create_exif_patch(header, photo)
 
-def _is_media_video(photo):
-    return photo['media'] == 'video'
+        if patch is None:
+            return False
+
+        start, end, replacement = patch
+        updated_path = path.with_name(path.name + '.exif')
+
+        with open(updated_path, 'wb') as updated_file:
+            updated_file.write(header[:start])
+            updated_file.write(replacement)
+            updated_file.write(header[end:])
+            shutil.copyfileobj(file, updated_file)
+
+    os.replace(updated_path, path)
+
+    return True
+
+def _create_exif_patch(data, photo):
+    """Returns a `(start, end, replacement)` tuple that replaces `data[start:end]` with an EXIF
+    segment containing the upload date, or `None` if the image already has a date or its format is
+    unsupported. Raises `IncompleteHeaderError` if `data` is a truncated header."""
+
+    if data.startswith(JPEG_SIGNATURE):
+        return _create_jpeg_exif_patch(data, photo)
+
+    if data.startswith(PNG_SIGNATURE):
+        return _create_png_exif_patch(data, photo)
+
+    return None
+
+def _create_jpeg_exif_patch(data, photo):
+    """Returns a patch for the APP1 EXIF segment of JPEG `data`."""
+
+    start, end, payload = _find_jpeg_exif_segment(data)
+
+    exif = _load_exif(payload)
+
+    if _exif_has_date(exif):
+        return None
+
+    _set_exif_date(exif, photo)
+
+    payload = exif.tobytes()
+    length = len(payload) + 2
+
+    # The segment length cannot be represented, e.g. due to a large embedded thumbnail.
+    if length > JPEG_MAX_SEGMENT_LENGTH:
+        return None
+
+    segment = bytes([0xFF, JPEG_APP1_MARKER]) + struct.pack('>H', length) + payload
+
+    return start, end, segment
+
+def _find_jpeg_exif_segment(data):
+    """Returns the `(start, end, payload)` of the APP1 EXIF segment in JPEG `data`, or an empty
+    range after any JFIF segment with a `None` payload if there is no EXIF segment."""
+
+    position = len(JPEG_SIGNATURE)
+    insert_position = position
+
+    # EXIF metadata is stored among the application segments that lead the image.
+    while True:
+        if position + 4 > len(data):
+            raise IncompleteHeaderError()
+
+        if data[position] != 0xFF:
+            return insert_position, insert_position, None
+
+        marker = data[position + 1]
 
-def _image_has_date(image):
-    """Returns a boolean indicating whether the image has any date information in its EXIF."""
+        is_application_marker = JPEG_APP0_MARKER <= marker <= 0xEF or marker == JPEG_COM_MARKER
 
-    exif = image.getexif()
+        if not is_application_marker:
+            return insert_position, insert_position, None
 
-    flags = [
-        ExifTags.Base.DateTime,
-        ExifTags.Base.DateTimeOriginal,
-        ExifTags.Base.DateTimeDigitized,
-    ]
+        (length,) = struct.unpack('>H', data[position + 2:position + 4])
+        end = position + 2 + length
 
-    return any([flag in exif for flag in flags])
+        if end > len(data):
+            raise IncompleteHeaderError()
 
-def _get_exif(image, photo):
-    """Returns an updated EXIF dictionary with date fields."""
+        payload = data[position + 4:end]
 
-    exif = image.getexif()
+        if marker == JPEG_APP1_MARKER and payload.startswith(EXIF_HEADER):
+            return position, end, payload
+
+        # Keep the JFIF segment first, as required by its specification.
+        if marker == JPEG_APP0_MARKER and position == insert_position:
+            insert_position = end
+
+        position = end
+
+def _create_png_exif_patch(data, photo):
+    """Returns a patch for the eXIf chunk of PNG `data`."""
+
+    start, end, payload = _find_png_exif_chunk(data)
+
+    exif = _load_exif(payload)
+
+    if _exif_has_date(exif):
+        return None
+
+    _set_exif_date(exif, photo)
+
+    payload = exif.tobytes()[len(EXIF_HEADER):]
+
+    chunk = (
+        struct.pack('>I', len(payload))
+        + PNG_EXIF_CHUNK
+        + payload
+        + struct.pack('>I', zlib.crc32(PNG_EXIF_CHUNK + payload))
+    )
+
+    return start, end, chunk
+
+def _find_png_exif_chunk(data):
+    """Returns the `(start, end, payload)` of the eXIf chunk in PNG `data`, or an empty range before
+    the image data with a `None` payload if there is no eXIf chunk."""
+
+    position = len(PNG_SIGNATURE)
+
+    while True:
+        if position + 8 > len(data):
+            raise IncompleteHeaderError()
+
+        (length,) = struct.unpack('>I', data[position:position + 4])
+        chunk_type = data[position + 4:position + 8]
+
+        if chunk_type in PNG_DATA_CHUNKS:
+            return position, position, None
+
+        end = position + 12 + length
+
+        if chunk_type == PNG_EXIF_CHUNK:
+            if end > len(data):
+                raise IncompleteHeaderError()
+
+            return position, end, data[position + 8:end - 4]
+
+        position = end
+
+def _load_exif(payload):
+    """Returns an EXIF object parsed from `payload`, without decoding any image."""
+
+    exif = Image.Exif()
+
+    if payload is not None:
+        exif.load(payload)
+
+    return exif
+
+def _is_media_video(photo):
+    return photo['media'] == 'video'
+
+def _exif_has_date(exif):
+    """Returns a boolean indicating whether the EXIF has any date information."""
+
+    exif_ifd = exif.get_ifd(ExifTags.IFD.Exif)
+
+    return (
+        ExifTags.Base.DateTime in exif
+        or ExifTags.Base.DateTimeOriginal in exif_ifd
+        or ExifTags.Base.DateTimeDigitized in exif_ifd
+    )
+
+def _set_exif_date(exif, photo):
+    """Updates the EXIF date fields in-place with the upload date."""
 
     timestamp = int(photo['posted'])
-    posted = str(datetime.datetime.fromtimestamp(timestamp))
+    posted = datetime.datetime.fromtimestamp(timestamp).strftime(DATE_FORMAT)
 
     exif[ExifTags.Base.DateTime] = posted
-    exif[ExifTags.Base.DateTimeOriginal] = posted
-    exif[ExifTags.Base.DateTimeDigitized] = posted
 
-    return exif
+    exif_ifd = exif.get_ifd(ExifTags.IFD.Exif)
+    exif_ifd[ExifTags.Base.DateTimeOriginal] = posted
+    exif_ifd[ExifTags.Base.DateTimeDigitized] = posted
@@ -1,4 +1,17 @@
+import os
 import json
+import mmap
+import hashlib
+from dataclasses import dataclass
+from pathlib import Path
+
+FILE_CHUNK_SIZE = 1024 * 1024
+
+@dataclass
+class IndexedFile:
+    path: Path
+    size: int
+    mtime: int
 
 def read_json_file(path):
     """Reads and returns the JSON object at `path`."""
@@ -20,3 +33,57 @@ def write_buffer(path, data):
 
     with open(path, 'wb') as file:
         file.write(data)
+
+def create_file_hash():
+    """Returns a new hash object used to fingerprint file contents."""
+
+    return hashlib.blake2b(digest_size=16)
+
+def hash_file(path):
+    """Returns the hex digest of the file at `path`, hashed from a memory map."""
+
+    hasher = create_file_hash()
+
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size > 0:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                hasher.update(data)
+
+    return hasher.hexdigest()
+
+async def read_file_chunks(path, chunk_size=FILE_CHUNK_SIZE, start=0, end=None):
+    """Yields the contents of the file at `path` from `start` up to `end`, or the end of the file, in
+    chunks from a memory map, without reading the whole file into memory."""
+
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            end = len(data) if end is None else min(end, len(data))
+
+            for i in range(start, end, chunk_size):
+                yield data[i:min(i + chunk_size, end)]
+
+def index_files(root):
+    """Returns a list of `IndexedFile` entries for every file beneath `root`, from directory listings
+    and `stat` calls alone."""
+
+    files = []
+    directories = [root]
+
+    while len(directories) > 0:
+        try:
+            entries = list(os.scandir(directories.pop()))
+        except FileNotFoundError:
+            continue
+
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+                continue
+
+            stat = entry.stat()
+            files.append(IndexedFile(Path(entry.path), stat.st_size, stat.st_mtime_ns))
+
+    return files
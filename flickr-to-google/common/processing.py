@@ -0,0 +1,65 @@
+import os
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+# CPU-bound image work runs on a process pool, so that it does not stall the event loop. Cap the
+# number of queued items per worker so that memory is not exhausted by waiting images.
+QUEUED_ITEMS_PER_WORKER = 2
+
+max_workers = os.cpu_count() or 1
+executor = None
+semaphore = None
+
+def configure_process_pool(workers):
+    """Sets the number of worker processes, which must be called before the pool's first use."""
+
+    global max_workers
+
+    assert executor is None
+
+    max_workers = workers
+
+def get_executor():
+    """Returns the process pool, creating it on first use."""
+
+    global executor
+
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+
+    return executor
+
+def shutdown_process_pool():
+    """Shuts down the process pool, if running."""
+
+    global executor, semaphore
+
+    if executor is not None:
+        executor.shutdown()
+        executor = None
+        semaphore = None
+
+async def submit(function, *args):
+    """Waits for capacity in the process pool queue, then submits `function(*args)` and returns a
+    future for its result."""
+
+    global semaphore
+
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(max_workers * QUEUED_ITEMS_PER_WORKER)
+
+    slots = semaphore
+    await slots.acquire()
+
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(get_executor(), function, *args)
+    future.add_done_callback(lambda _: slots.release())
+
+    return future
+
+async def run_in_process(function, *args):
+    """Runs `function(*args)` in the process pool and returns its result."""
+
+    future = await submit(function, *args)
+
+    return await future
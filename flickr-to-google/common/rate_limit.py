@@ -0,0 +1,163 @@
+import time
+import asyncio
+import datetime
+from zoneinfo import ZoneInfo
+
+from .directory import read_quota_usage, write_quota_usage
+from .log import print_timestamped
+from .retry import PermanentError
+
+# On throttling, multiply the rate by this factor, down to a minimum proportion of the configured
+# rate; then recover additively by a proportion of the configured rate on each success.
+THROTTLE_DECREASE_FACTOR = 0.5
+THROTTLE_MIN_PROPORTION = 0.05
+THROTTLE_RECOVERY_PROPORTION = 0.01
+
+# Responses with these statuses indicate that requests are being sent too quickly:
+THROTTLING_STATUS_CODES = [429, 503]
+
+# Daily quotas reset at midnight Pacific Time.
+QUOTA_TIMEZONE = ZoneInfo('America/Los_Angeles')
+
+# Quota usage is counted in memory, and written once per this many requests and on shutdown:
+QUOTA_SAVE_INTERVAL = 100
+
+class QuotaExhaustedError(PermanentError):
+    """Raised when the daily quota for an endpoint has been spent."""
+
+class RateLimiter:
+    """Limits requests to an endpoint with a token bucket refilled at `rate` requests per second,
+    holding up to `burst` requests, and with an optional daily quota shared across runs. The rate
+    backs off on throttled responses and recovers gradually on successes."""
+
+    def __init__(self, name, rate, burst=1, daily_quota=None):
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.daily_quota = daily_quota
+
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = asyncio.Lock()
+
+        # The usage counted against the daily quota on `quota_day`, read once per day:
+        self.quota_day = None
+        self.quota_usage = 0
+        self.unsaved_usage = 0
+
+    def configure(self, rate=None, daily_quota=None):
+        """Overrides the configured rate and daily quota."""
+
+        if rate is not None:
+            self.max_rate = rate
+            self.rate = rate
+
+        if daily_quota is not None:
+            self.daily_quota = daily_quota
+
+    async def acquire(self):
+        """Waits until a request may be sent, and counts it against the daily quota."""
+
+        async with self.lock:
+            while (delay := self._get_delay()) > 0:
+                await asyncio.sleep(delay)
+
+            self.tokens -= 1
+            self._spend_quota()
+
+    def save_quota_usage(self):
+        """Writes the usage counted against the daily quota, if any has not been written."""
+
+        if self.unsaved_usage == 0:
+            return
+
+        write_quota_usage(self.name, self.quota_day, self.quota_usage)
+        self.unsaved_usage = 0
+
+    def on_success(self):
+        """Recovers the rate after a request that was not throttled."""
+
+        recovery = self.max_rate * THROTTLE_RECOVERY_PROPORTION
+        self.rate = min(self.max_rate, self.rate + recovery)
+
+    def on_throttled(self, retry_after=None):
+        """Backs off after a throttled request, pausing for `retry_after` seconds if given."""
+
+        minimum = self.max_rate * THROTTLE_MIN_PROPORTION
+        self.rate = max(minimum, self.rate * THROTTLE_DECREASE_FACTOR)
+
+        if retry_after is not None:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+        print_timestamped(
+            'Throttled by {}; reduced the rate to {:.2f} request(s) per second.'.format(
+                self.name,
+                self.rate,
+            )
+        )
+
+    def _get_delay(self):
+        """Refills the bucket and returns the seconds to wait before a token is available."""
+
+        now = time.monotonic()
+
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.paused_until > now:
+            return self.paused_until - now
+
+        if self.tokens >= 1:
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+    def _spend_quota(self):
+        """Counts a request against the daily quota, raising if it has been spent."""
+
+        if self.daily_quota is None:
+            return
+
+        day = datetime.datetime.now(QUOTA_TIMEZONE).date().isoformat()
+
+        if day != self.quota_day:
+            self.save_quota_usage()
+
+            self.quota_day = day
+            self.quota_usage = read_quota_usage(self.name, day)
+
+        if self.quota_usage >= self.daily_quota:
+            raise QuotaExhaustedError(
+                f'Spent the daily quota of {self.daily_quota} request(s) for {self.name}'
+            )
+
+        self.quota_usage += 1
+        self.unsaved_usage += 1
+
+        if self.unsaved_usage >= QUOTA_SAVE_INTERVAL:
+            self.save_quota_usage()
+
+def parse_retry_after(response):
+    """Returns the `Retry-After` delay of `response` in seconds, or `None` if absent."""
+
+    value = response.headers.get('Retry-After', None)
+
+    if value is None:
+        return None
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    # Otherwise, the value is an HTTP date.
+    try:
+        date = datetime.datetime.strptime(value, '%a, %d %b %Y %H:%M:%S GMT')
+    except ValueError:
+        return None
+
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+    return max(0, (date - now).total_seconds())
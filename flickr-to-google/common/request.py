@@ -1,54 +1,227 @@
+import os
+import re
 import httpx
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Optional
+from pathlib import Path
+
 from .config import read_config
+from .exif import (
+    HEADER_READ_SIZE,
+    updated_header_with_exif,
+    update_file_with_exif,
+)
+from .files import create_file_hash, hash_file
+from .processing import run_in_process
+from .retry import TransientError, raise_for_response
+from .budget import get_byte_budget
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 
-from .exif import updated_data_with_exif
+# Streamed content holds the header read for its EXIF update and one chunk in memory at a time:
+STREAM_RESERVED_SIZE = HEADER_READ_SIZE + DOWNLOAD_CHUNK_SIZE
+DOWNLOAD_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
 
-def download_photo_bytes(photo):
-    """Downloads the photo content and returns the url and parsed bytes."""
+@dataclass
+class DownloadedFile:
+    path: Path
 
-    url, data = _download(photo)
+    # These identify the completed file, to verify it before reuse.
+    size: int
+    digest: str
 
-    if data is None:
-        return url, data, False
+    did_update_exif: bool
 
-    data, did_update_exif = updated_data_with_exif(data, photo)
+@dataclass
+class StreamedPhoto:
+    # An async iterator over the body, with the EXIF metadata updated:
+    content: AsyncIterator[bytes]
 
-    return url, data, did_update_exif
+    # The size of the updated body, or `None` if the server does not declare it.
+    size: Optional[int]
 
-def _download(photo):
-    """Downloads the photo content and returns the url and raw bytes."""
+    did_update_exif: bool
 
-    cookies = _get_request_cookies(photo)
+# Shared download clients, keyed by whether they carry the Flickr cookies:
+clients = {}
 
-    request_url = photo['url']
+def get_client(is_authenticated=False):
+    """Returns a shared download client, creating it on first use. Authenticated clients send the
+    Flickr cookies required for full-quality videos, including across redirects."""
 
-    try:
-        response = httpx.get(
-            request_url,
+    if is_authenticated not in clients:
+        clients[is_authenticated] = httpx.AsyncClient(
+            cookies=_get_request_cookies() if is_authenticated else None,
             follow_redirects=True,
-            cookies=cookies
+            timeout=DOWNLOAD_TIMEOUT,
         )
 
-        url = str(response.url)
-        data = response.content
+    return clients[is_authenticated]
+
+async def close_clients():
+    """Closes the shared download clients."""
+
+    for client in clients.values():
+        await client.aclose()
+
+    clients.clear()
+
+async def download_photo_file(photo, get_path, part_path):
+    """Streams the photo content to `part_path`, resuming from any bytes already there, then moves
+    it to the path returned by `get_path(url)`, given the final URL, and returns a `DownloadedFile`.
+    Interrupted downloads are kept at `part_path` to be resumed by the next attempt. Only a chunk
+    is held in memory at a time, which is reserved before the request is opened so that waiting
+    downloads do not hold idle connections."""
+
+    offset = part_path.stat().st_size if part_path.is_file() else 0
+    headers = {'Range': f'bytes={offset}-'} if offset > 0 else None
+
+    hasher = create_file_hash()
+
+    # The EXIF update reads no more than the header, which is smaller than a chunk.
+    async with (
+        get_byte_budget().reserve(DOWNLOAD_CHUNK_SIZE),
+        stream_photo(photo, headers) as response,
+    ):
+        is_misplaced_range = (
+            response.status_code == 206
+            and _get_range_start(response) != offset
+        )
+
+        if response.status_code == 416 or is_misplaced_range:
+            # The partial file does not match the content; discard it and start again.
+            part_path.unlink(missing_ok=True)
+            raise TransientError(f'Could not resume the download of {part_path.name}')
+
+        if response.status_code == 206:
+            mode = 'ab'
+        else:
+            # The server does not support ranges, so the whole body is sent.
+            raise_for_response(response)
+            offset = 0
+            mode = 'wb'
+
+        expected_size = _get_content_size(response, offset)
+
+        path = get_path(str(response.url))
+        part_path.parent.mkdir(parents=True, exist_ok=True)
+
+        size = offset
+
+        with open(part_path, mode) as file:
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                file.write(chunk)
+                hasher.update(chunk)
+                size += len(chunk)
+
+        if expected_size is not None and size != expected_size:
+            raise TransientError(
+                f'Received {size} of {expected_size} byte(s) for {part_path.name}'
+            )
+
+        did_update_exif = await run_in_process(update_file_with_exif, part_path, photo)
+        digest = hasher.hexdigest()
+
+        # Re-hash resumed downloads and rewritten images, since the streamed hash does not
+        # cover them.
+        if offset > 0 or did_update_exif:
+            size = part_path.stat().st_size
+            digest = await run_in_process(hash_file, part_path)
+
+        # Only complete files are moved into place, so that they are never mistaken for partial
+        # ones.
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(part_path, path)
+
+    return DownloadedFile(path, size, digest, did_update_exif)
+
+@asynccontextmanager
+async def stream_photo_with_exif(photo):
+    """Opens a streaming request for the photo content and yields a `StreamedPhoto`, whose EXIF
+    metadata is updated from the header bytes alone. Only the header and one chunk are held in memory
+    at a time, as the body is read only as fast as it is consumed. These are reserved before the
+    request is opened, so that waiting items do not hold idle connections."""
+
+    async with (
+        get_byte_budget().reserve(STREAM_RESERVED_SIZE),
+        stream_photo(photo) as response,
+    ):
+        raise_for_response(response)
+
+        chunks = response.aiter_bytes(DOWNLOAD_CHUNK_SIZE)
+        header = b''
+
+        async for chunk in chunks:
+            header += chunk
+
+            if len(header) >= HEADER_READ_SIZE:
+                break
+
+        updated_header, did_update_exif = await run_in_process(
+            updated_header_with_exif,
+            header,
+            photo,
+        )
+
+        size = _get_content_size(response, 0)
+
+        if size is not None:
+            size += len(updated_header) - len(header)
+
+        async def iterate_content():
+            yield updated_header
 
-        if response.status_code != 200:
-            return url, None
+            async for chunk in chunks:
+                yield chunk
 
-        return url, data
-    except Exception:
-        return request_url, None
+        yield StreamedPhoto(iterate_content(), size, did_update_exif)
 
-def _get_request_cookies(photo):
-    """Returns the cookies required to fetch `photo`."""
+@asynccontextmanager
+async def stream_photo(photo, headers=None):
+    """Opens a streaming request for the photo content and yields the response, whose body can be
+    consumed in chunks with `aiter_bytes`."""
 
-    if photo['media'] != 'video':
+    client = get_client(_is_media_video(photo))
+
+    async with client.stream('GET', photo['url'], headers=headers) as response:
+        yield response
+
+def _get_range_start(response):
+    """Returns the first byte position of a partial `response`, or `None` if it is not given."""
+
+    match = re.match(r'bytes (\d+)-', response.headers.get('Content-Range', ''))
+
+    return None if match is None else int(match.group(1))
+
+def _get_content_size(response, offset):
+    """Returns the total size of the content in `response`, which starts at `offset`, or `None` if
+    the server does not declare it."""
+
+    match = re.match(r'bytes \d+-\d+/(\d+)', response.headers.get('Content-Range', ''))
+
+    if match is not None:
+        return int(match.group(1))
+
+    content_length = response.headers.get('Content-Length', None)
+
+    # Lengths of compressed bodies do not correspond to the bytes written.
+    if content_length is None or 'Content-Encoding' in response.headers:
         return None
 
+    return offset + int(content_length)
+
+def _is_media_video(photo):
+    """Returns a boolean indicating whether the media item is a video."""
+
+    return photo['media'] == 'video'
+
+def _get_request_cookies():
+    """Returns the cookies required to fetch full-quality videos."""
+
     config = read_config()
 
     return {
         'cookie_session': config.flickr_cookie_session,
         'cookie_epass': config.flickr_cookie_epass,
     }
-
@@ -0,0 +1,210 @@
+import random
+import asyncio
+from dataclasses import dataclass
+from typing import Any
+
+import httpx
+import requests
+
+from .concurrency import PROGRESS_INTERVAL
+from .log import print_timestamped
+
+RETRY_LIMIT = 10
+
+# Delays between attempts grow exponentially from the base, up to the maximum, with full jitter:
+RETRY_BASE_DELAY_SECONDS = 1
+RETRY_MAX_DELAY_SECONDS = 120
+
+TRANSIENT_STATUS_CODES = [408, 429]
+
+class TransientError(Exception):
+    """Raised for failures that are likely to succeed on retry, such as timeouts."""
+
+class PermanentError(Exception):
+    """Raised for failures that will not succeed on retry, such as missing items."""
+
+@dataclass
+class RetryEntry:
+    item: Any
+    attempts: int = 0
+    error: Exception = None
+
+def is_transient_error(err):
+    """Returns a boolean indicating whether the failure `err` is worth retrying. Only transient
+    errors, network failures such as timeouts and dropped connections, and transient statuses are
+    retried; any other error, such as a bug, is treated as permanent."""
+
+    if isinstance(err, httpx.HTTPStatusError):
+        return is_transient_status(err.response.status_code)
+
+    # Flickr queries are sent with `requests`, and all other requests with `httpx`.
+    return isinstance(err, (TransientError, httpx.TransportError, requests.RequestException))
+
+def is_transient_status(status_code):
+    """Returns a boolean indicating whether an HTTP status code indicates a transient failure."""
+
+    return status_code in TRANSIENT_STATUS_CODES or status_code >= 500
+
+def raise_for_response(response):
+    """Raises a classifiable error unless `response` is a successful response."""
+
+    if response is None:
+        raise TransientError('No response received')
+
+    if response.status_code != 200:
+        raise httpx.HTTPStatusError(
+            f'Received status {response.status_code} for {response.request.url}',
+            request=response.request,
+            response=response,
+        )
+
+def get_retry_delay(attempts):
+    """Returns a jittered, exponentially increasing delay in seconds following `attempts` failures."""
+
+    limit = min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** (attempts - 1))
+
+    return random.uniform(0, limit)
+
+class RetryQueue:
+    """Runs items through `handler` on a bounded pool of workers, and retries failed items
+    individually with jittered exponential backoff. Items that fail permanently, or that exhaust
+    their attempts, are parked in `dead_letters` instead of being retried.
+
+    By default, an item succeeds once `handler` returns. If `on_result` is set, it is awaited with
+    the entry and the handler's result instead, and must eventually call `succeed` or `fail` for the
+    entry; this allows items to pass through later stages before they are considered complete.
+    `on_parked`, if set, is called with each entry as it is parked."""
+
+    def __init__(
+        self,
+        handler,
+        concurrency,
+        on_result=None,
+        on_parked=None,
+        progress_handler=None,
+        retry_limit=RETRY_LIMIT,
+    ):
+        self.handler = handler
+        self.concurrency = concurrency
+        self.on_result = on_result
+        self.on_parked = on_parked
+        self.progress_handler = progress_handler
+        self.retry_limit = retry_limit
+
+        self.results = []
+        self.dead_letters = []
+
+        self.items = None
+        self.is_exhausted = False
+        self.retries = asyncio.Queue()
+        self.num_outstanding = 0
+        self.num_completed = 0
+
+    async def run(self, items):
+        """Processes `items` until each has succeeded or been parked, and returns the number of
+        items that succeeded and attempted."""
+
+        self.items = iter(items)
+
+        workers = [
+            asyncio.create_task(self._run_worker())
+            for _ in range(self.concurrency)
+        ]
+
+        await asyncio.gather(*workers)
+
+        if self.progress_handler is not None and self.num_completed % PROGRESS_INTERVAL != 0:
+            self.progress_handler(self.get_counts())
+
+        return self.get_counts()
+
+    def get_counts(self):
+        """Returns a tuple with the number of items succeeded and completed so far."""
+
+        return len(self.results), self.num_completed
+
+    def succeed(self, entry, result):
+        """Records a successful result for `entry`."""
+
+        self.results.append(result)
+        self._complete()
+
+    def fail(self, entry, err):
+        """Records a failed attempt for `entry`, scheduling a retry if the error is transient and
+        attempts remain, or parking it otherwise."""
+
+        entry.attempts += 1
+        entry.error = err
+
+        if is_transient_error(err) and entry.attempts < self.retry_limit:
+            delay = get_retry_delay(entry.attempts)
+            asyncio.get_running_loop().call_later(delay, self.retries.put_nowait, entry)
+            return
+
+        self.dead_letters.append(entry)
+        self._complete()
+
+        if self.on_parked is not None:
+            self.on_parked(entry)
+
+    def print_dead_letters(self, describe):
+        """Prints the parked items, described by `describe(item)`, with their last errors."""
+
+        for entry in self.dead_letters:
+            print_timestamped(
+                'Gave up on {} after {} attempt(s): {}'.format(
+                    describe(entry.item),
+                    entry.attempts,
+                    entry.error,
+                )
+            )
+
+    async def _run_worker(self):
+        """Processes entries until no items remain outstanding."""
+
+        while (entry := await self._get_next_entry()) is not None:
+            try:
+                result = await self.handler(entry.item)
+            except Exception as err:
+                self.fail(entry, err)
+                continue
+
+            if self.on_result is None:
+                self.succeed(entry, result)
+            else:
+                await self.on_result(entry, result)
+
+    async def _get_next_entry(self):
+        """Returns the next entry to process, preferring retries over new items, or `None` once
+        every item has completed."""
+
+        if not self.retries.empty():
+            return self.retries.get_nowait()
+
+        if not self.is_exhausted:
+            item = next(self.items, None)
+
+            if item is not None:
+                self.num_outstanding += 1
+                return RetryEntry(item)
+
+            self.is_exhausted = True
+
+        if self.num_outstanding == 0:
+            return None
+
+        # Wait for a scheduled retry, or for a `None` entry signalling completion.
+        return await self.retries.get()
+
+    def _complete(self):
+        """Marks an outstanding item as complete, releasing idle workers once none remain."""
+
+        self.num_outstanding -= 1
+        self.num_completed += 1
+
+        if self.progress_handler is not None and self.num_completed % PROGRESS_INTERVAL == 0:
+            self.progress_handler(self.get_counts())
+
+        if self.num_outstanding == 0 and self.is_exhausted:
+            for _ in range(self.concurrency):
+                self.retries.put_nowait(None)
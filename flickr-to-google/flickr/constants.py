@@ -6,7 +6,23 @@ class Endpoints(StrEnum):
 
 class PhotoEntryKeys(StrEnum):
     DOWNLOAD_FILE_PATH = 'image_path'
+    DOWNLOAD_FILE_SIZE = 'image_size'
+    DOWNLOAD_FILE_HASH = 'image_hash'
+    DOWNLOAD_FILE_MTIME = 'image_mtime'
     DID_UPDATE_EXIF = 'did_update_exif'
 
 QUERIES_PER_PAGE = 500
+
+# Extra fields requested on photo listings to populate entries without per-photo queries:
+# - https://www.flickr.com/services/api/flickr.people.getPhotos.html
+PHOTO_LISTING_EXTRAS = 'url_o,description,date_upload,media'
+
+# Extra fields requested when listing photo identifiers, to track the latest upload for incremental
+# synchronization:
+PHOTO_IDENTIFIER_EXTRAS = 'date_upload'
 REQUESTS_BATCH_SIZE = 10
+
+# Flickr limits each API key to 3600 queries per hour:
+# - https://www.flickr.com/services/developer/api/
+QUERIES_PER_SECOND = 3600 / (60 * 60)
+QUERIES_BURST = REQUESTS_BATCH_SIZE
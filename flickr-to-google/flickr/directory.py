@@ -1,81 +1,275 @@
 import asyncio
+import datetime
 import json
 from pathlib import Path
 
-from .photos import query_photo_identifiers
-from .photosets import query_photosets
-from common.directory import write_album_metadata, write_photo_data
+from .photos import query_photo_identifiers, iterate_photo_identifier_pages
+from .photosets import query_photosets, iterate_photoset_pages, query_photoset_data
+from .query import query_concurrently
+from common.directory import (
+    PHOTOSTREAM_DIRECTORY,
+    ALBUM_IDS_KEY,
+    read_album_metadata,
+    read_albums,
+    read_photos_data,
+    read_state,
+    delete_state,
+    write_album_metadata,
+    write_albums_metadata,
+    write_photos_data,
+    write_state,
+)
 from common.log import print_timestamped, print_separator
 from .api import init as init_flickr_api
 
-async def create_directory():
-    """Creates an unpopulated directory with `photosets` and `photo` identifiers."""
+# The latest upload date seen, from which incremental updates list new photos:
+UPLOAD_DATE_MARK_KEY = 'upload-date-mark'
+
+# The progress of an unfinished directory creation, from which it resumes:
+CHECKPOINT_KEY = 'directory-checkpoint'
+
+INITIAL_CHECKPOINT = {
+    'photoset_pages': 0,
+    'photo_pages': 0,
+    'num_photosets': 0,
+    'num_photos': 0,
+    'upload_date_mark': None,
+}
+
+async def create_directory(is_incremental=False):
+    """Creates an unpopulated directory with `photosets` and `photo` identifiers, committing each
+    photoset and each page of photos as it arrives, and resuming an interrupted run from its last
+    committed page. If `is_incremental` is set and the directory has been created before, only new
+    photos and changed photosets are added instead."""
 
     init_flickr_api()
-    _print_init()
 
-    photo_identifiers = await query_photo_identifiers()
-    photosets = await query_photosets()
+    upload_date_mark = read_state(UPLOAD_DATE_MARK_KEY)
 
-    _validate_directory_queries(photo_identifiers, photosets)
+    if is_incremental and upload_date_mark is not None:
+        await _update_directory(upload_date_mark)
+        return
 
-    _write_photoset_directory_files(photosets)
-    _write_photo_directory_files(photo_identifiers, photosets)
+    checkpoint = read_state(CHECKPOINT_KEY, dict(INITIAL_CHECKPOINT))
 
-    _print_summary(photosets)
+    _print_init(checkpoint)
 
-def _write_photoset_directory_files(photosets):
-    """Writes directory files for `photosets`."""
+    # Photosets are written first, so that each photo is placed in the directory of its first
+    # photoset; the photo listing then adds the photos in no photoset to the photostream.
+    await _create_photoset_entries(checkpoint)
+    await _create_photo_entries(checkpoint)
 
-    for photoset in photosets:
-        write_album_metadata(photoset)
+    if checkpoint['upload_date_mark'] is not None:
+        write_state(UPLOAD_DATE_MARK_KEY, checkpoint['upload_date_mark'])
+
+    delete_state(CHECKPOINT_KEY)
+
+    _print_summary(checkpoint)
+
+async def _create_photoset_entries(checkpoint):
+    """Writes each photoset, and the skeleton entries of its photos, as soon as it is fetched, and
+    checkpoints each completed page of photosets."""
+
+    start_page = checkpoint['photoset_pages'] + 1
+
+    async for photosets in iterate_photoset_pages(start_page):
+        queries = [_create_photoset_entry(photoset) for photoset in photosets]
+        await query_concurrently(queries)
 
-def _write_photo_directory_files(photo_identifiers, photosets):
-    """Writes `{ id: photo_id }` directory skeleton files for `photos` given `photosets`."""
+        checkpoint['photoset_pages'] += 1
+        checkpoint['num_photosets'] += len(photosets)
+        write_state(CHECKPOINT_KEY, checkpoint)
+
+        _print_photoset_progress(checkpoint)
+
+async def _create_photoset_entry(photoset):
+    """Queries the photos of `photoset`, then writes its album metadata and the skeleton entries of
+    its photos."""
+
+    photoset = await query_photoset_data(photoset)
+
+    # Preserve the fields of an album written previously, such as its Google Photos album ID.
+    try:
+        album = read_album_metadata(photoset['id'])
+    except KeyError:
+        album = {}
+
+    write_album_metadata({**album, **photoset})
+
+    photo_ids = photoset['photo_ids']
+    entries = read_photos_data(photo_ids)
+
+    _write_photo_entries(
+        (photo_id, entries.get(photo_id, None), [photoset['id']])
+        for photo_id in photo_ids
+    )
 
-    photo_photosets = _get_photo_photosets(photosets)
+async def _create_photo_entries(checkpoint):
+    """Writes skeleton entries for the photos in no photoset, a page of photos at a time, and
+    checkpoints each completed page."""
 
-    for photo_id in photo_identifiers:
-        photoset_id = photo_photosets.get(photo_id, None)
-        photo = { 'id': photo_id }
-        _write_photo_directory_file(photo, photoset_id)
+    start_page = checkpoint['photo_pages'] + 1
 
-def _get_photo_photosets(photosets):
-    """Returns a directory of `photo_id` to `photoset_id` for each photo in a photoset."""
+    async for photo_listings in iterate_photo_identifier_pages(start_page):
+        photo_ids = [photo_id for photo_id, _ in photo_listings]
+        entries = read_photos_data(photo_ids)
 
+        _write_photo_entries(
+            (photo_id, entries.get(photo_id, None), [])
+            for photo_id in photo_ids
+        )
+
+        upload_dates = [date_upload for _, date_upload in photo_listings]
+
+        if checkpoint['upload_date_mark'] is not None:
+            upload_dates.append(checkpoint['upload_date_mark'])
+
+        checkpoint['photo_pages'] += 1
+        checkpoint['num_photos'] += len(photo_listings)
+        checkpoint['upload_date_mark'] = max(upload_dates, default=None)
+        write_state(CHECKPOINT_KEY, checkpoint)
+
+        _print_photo_progress(checkpoint)
+
+async def _update_directory(upload_date_mark):
+    """Adds the photos uploaded since `upload_date_mark`, and the new memberships of photosets whose
+    counts or update dates have changed, to the directory."""
+
+    _print_update_init(upload_date_mark)
+
+    photo_listings = await query_photo_identifiers(min_upload_date=upload_date_mark)
+
+    albums = {album['id']: album for album in read_albums()}
+    photosets = await query_photosets(albums)
+
+    # Find the photosets that each photo has joined since the last update.
     photo_photosets = {}
 
     for photoset in photosets:
+        album = albums.get(photoset['id'], {})
+        known_photo_ids = set(album.get('photo_ids', []))
+
         for photo_id in photoset['photo_ids']:
-            photo_photosets[photo_id] = photoset['id']
+            if photo_id not in known_photo_ids:
+                photo_photosets.setdefault(photo_id, []).append(photoset['id'])
 
-    return photo_photosets
+    photo_ids = [photo_id for photo_id, _ in photo_listings] + list(photo_photosets.keys())
+    photo_ids = list(dict.fromkeys(photo_ids))
+    entries = read_photos_data(photo_ids)
 
-def _validate_directory_queries(photo_identifiers, photosets):
-    """Verifies that the photos requested in photosets are present in photos."""
+    write_albums_metadata(photosets)
 
-    photo_ids = set(photo_identifiers)
+    num_photos = _write_photo_entries(
+        (photo_id, entries.get(photo_id, None), photo_photosets.get(photo_id, []))
+        for photo_id in photo_ids
+    )
 
-    for photoset in photosets:
-        for photo_id in photoset['photo_ids']:
-            assert photo_id in photo_ids
+    upload_dates = [date_upload for _, date_upload in photo_listings] + [upload_date_mark]
+    write_state(UPLOAD_DATE_MARK_KEY, max(upload_dates))
+
+    num_changed = sum(1 for photoset in photosets if albums.get(photoset['id'], None) != photoset)
+
+    _print_update_summary(num_photos, num_changed)
+
+def _write_photo_entries(updates):
+    """Writes the entries for `(photo_id, entry, photoset_ids)` updates, where `entry` is the
+    existing `(directory, photo)` entry or `None`, and returns the number of entries written."""
 
-def _write_photo_directory_file(photo, photoset_id=None):
-    """Writes a photo directory file for photo within the directory corresponding to `photoset_id`."""
+    directories = {}
 
-    directory = 'photostream' if photoset_id is None else photoset_id
-    write_photo_data(directory, photo)
+    for photo_id, entry, photoset_ids in updates:
+        directory, photo = _update_photo_albums(photo_id, entry, photoset_ids)
 
-def _print_init():
+        if photo is not None:
+            directories.setdefault(directory, []).append(photo)
+
+    for directory, photos in directories.items():
+        write_photos_data(directory, photos)
+
+    return sum(len(photos) for photos in directories.values())
+
+def _update_photo_albums(photo_id, entry, photoset_ids):
+    """Returns the `(directory, photo)` entry for `photo_id` with `photoset_ids` added to its albums,
+    creating a skeleton entry, placed in the directory of its first photoset, if the photo is new, or
+    `(None, None)` if it is unchanged."""
+
+    if entry is None:
+        if len(photoset_ids) == 0:
+            return PHOTOSTREAM_DIRECTORY, { 'id': photo_id }
+
+        return photoset_ids[0], { 'id': photo_id, ALBUM_IDS_KEY: photoset_ids }
+
+    directory, photo = entry
+
+    # Entries created before albums were recorded belong only to their directory.
+    album_ids = photo.get(ALBUM_IDS_KEY, [] if directory == PHOTOSTREAM_DIRECTORY else [directory])
+    updated_album_ids = list(dict.fromkeys(album_ids + photoset_ids))
+
+    if updated_album_ids == album_ids:
+        return None, None
+
+    photo[ALBUM_IDS_KEY] = updated_album_ids
+
+    return directory, photo
+
+def _print_init(checkpoint):
     """Prints a download initiation message."""
 
     print_separator()
-    print_timestamped('Beginning to create the directory.')
 
-def _print_summary(photosets):
+    if checkpoint == INITIAL_CHECKPOINT:
+        print_timestamped('Beginning to create the directory.')
+        return
+
+    print_timestamped(
+        'Resuming directory creation after {} page(s) of albums and {} page(s) of photos.'.format(
+            checkpoint['photoset_pages'],
+            checkpoint['photo_pages'],
+        )
+    )
+
+def _print_photoset_progress(checkpoint):
+    """Prints a summary of the photosets committed so far."""
+
+    print_timestamped(
+        'Added {} album(s) to the directory.'.format(checkpoint['num_photosets'])
+    )
+
+def _print_photo_progress(checkpoint):
+    """Prints a summary of the photos listed so far."""
+
+    print_timestamped(
+        'Listed {} photo(s) for the directory.'.format(checkpoint['num_photos'])
+    )
+
+def _print_update_init(upload_date_mark):
+    """Prints an update initiation message."""
+
+    print_separator()
+    print_timestamped(
+        'Beginning to update the directory with photos uploaded since {}.'.format(
+            datetime.datetime.fromtimestamp(upload_date_mark),
+        )
+    )
+
+def _print_update_summary(num_photos, num_changed):
+    """Prints a final update summary."""
+
+    print_separator()
+    print_timestamped(
+        'Updated the directory with {} new or changed photo(s) and {} changed album(s).'.format(
+            num_photos,
+            num_changed,
+        )
+    )
+
+def _print_summary(checkpoint):
     """Prints a final download summary."""
 
     print_separator()
     print_timestamped(
-        'Created the directory with {} album(s).'.format(len(photosets))
+        'Created the directory with {} album(s) and {} photo(s).'.format(
+            checkpoint['num_photosets'],
+            checkpoint['num_photos'],
+        )
     )
@@ -1,87 +1,144 @@
-import asyncio
 import os
 from pathlib import Path
 from urllib.parse import urlparse
 import mimetypes
 
 from common.directory import (
-    get_outputs_path,
-    get_directory_path,
+    PHOTOSTREAM_DIRECTORY,
+    count_photos,
+    iterate_photos,
     read_album_metadata,
     write_photo_data,
-    read_photo_data,
 )
 from .constants import REQUESTS_BATCH_SIZE, PhotoEntryKeys
 from common.log import print_timestamped, print_separator
-from common.request import download_photo_bytes
-from common.files import write_buffer
-
-async def download_photos(path, is_downloading_all=False, is_videos_only=False):
+from common.retry import RetryQueue
+from common.request import download_photo_file
+from common.files import index_files, hash_file
+from common.processing import run_in_process
+
+# Files with these suffixes are incomplete downloads or EXIF updates:
+PARTIAL_FILE_SUFFIXES = ['.part', '.exif']
+
+async def download_photos(
+    path,
+    is_downloading_all=False,
+    is_videos_only=False,
+    concurrency=None,
+):
     """Downloads all photos to `path` and updates the entry files, printing output summaries throughout."""
 
-    requests = _get_requests(path, is_downloading_all, is_videos_only)
+    filters = _get_pending_filters(is_downloading_all, is_videos_only)
+
+    _print_init(count_photos(**filters))
 
-    _print_init(requests)
+    # Index the files already present, so that intact downloads are recorded without any requests.
+    present_files = _index_download_root(path)
+    num_present = 0
 
-    responses = []
+    async def download_photo(item):
+        nonlocal num_present
 
-    for i in range(0, len(requests), REQUESTS_BATCH_SIZE):
-        batch = requests[i:i + REQUESTS_BATCH_SIZE]
-        batch_responses = await asyncio.gather(*batch)
-        _print_batch_summary(batch_responses)
-        responses += batch_responses
+        directory, photo = item
+        present_file = await _find_present_file(present_files, directory, photo)
 
-    _print_summary(responses)
+        if present_file is not None:
+            num_present += 1
+            await _record_present_file(directory, photo, present_file)
 
-    return _get_downloaded_count(responses)
+            return photo
 
-def _get_requests(root_path, is_downloading_all, is_videos_only):
-    """Returns a list of requests for all remaining photos."""
+        return await _download_photo(path, directory, photo)
 
-    requests = []
+    retry_queue = RetryQueue(
+        download_photo,
+        concurrency or REQUESTS_BATCH_SIZE,
+        progress_handler=_print_progress,
+    )
 
-    _, directories, _ = next(os.walk(get_outputs_path()))
+    counts = await retry_queue.run(iterate_photos(**filters))
 
-    for directory in directories:
+    _print_summary(counts, retry_queue, num_present)
 
-        _, _, filenames = next(os.walk(get_directory_path(directory)))
+    return counts
 
-        for filename in filenames:
-            if filename == 'metadata.json':
-                continue
+def _get_pending_filters(is_downloading_all, is_videos_only):
+    """Returns the directory filters that match all remaining photos."""
 
-            photo = read_photo_data(directory, filename)
+    # Ignore photos that were not properly fetched:
+    return {
+        'is_populated': True,
+        'is_downloaded': None if is_downloading_all else False,
+        'is_video': True if is_videos_only else None,
+    }
 
-            # Ignore photos that were not properly fetched:
-            if len(photo.keys()) <= 1:
-                continue
+async def _download_photo(root_path, directory, photo):
+    """Downloads the photo bytes for `photo` to the corresponding filepath."""
 
-            if not is_downloading_all and PhotoEntryKeys.DOWNLOAD_FILE_PATH in photo:
-                continue
+    def get_path(url):
+        filename = _get_download_filename(photo, url)
+        return _get_download_path(root_path, directory, filename)
 
-            if is_videos_only and not _is_media_video(photo):
-                continue
+    # The partial file is named by ID alone, as the extension is only known from the final URL.
+    part_path = _get_download_path(root_path, directory, Path(f'{photo["id"]}.part'))
 
-            requests.append(_download_photo(root_path, directory, photo))
+    downloaded_file = await download_photo_file(photo, get_path, part_path)
 
-    return requests
+    _update_photo_entry(directory, photo, downloaded_file)
 
-async def _download_photo(root_path, directory, photo):
-    """Downloads the photo bytes for `photo` to the corresponding filepath."""
+    return photo
 
-    url, data, did_update_exif = download_photo_bytes(photo)
+def _index_download_root(root_path):
+    """Returns the complete files beneath `root_path`, keyed by their folder name and photo ID."""
+
+    index = {}
+
+    for file in index_files(root_path):
+        if file.path.suffix in PARTIAL_FILE_SUFFIXES:
+            continue
+
+        index[(file.path.parent.name, file.path.stem)] = file
+
+    return index
+
+async def _find_present_file(present_files, directory, photo):
+    """Returns the indexed file for `photo` if it is present and matches the recorded size and hash,
+    or `None` otherwise. Without a recorded size, e.g. after the directory is recreated, any
+    non-empty file is complete, since downloads are only moved into place once finished."""
+
+    folder = _get_download_folder(directory)
+    file = present_files.get((folder, photo['id']), None)
 
-    if data is None:
+    if file is None or file.size == 0:
         return None
 
-    filename = _get_download_filename(photo, url)
-    path = _get_download_path(root_path, directory, filename)
+    size = photo.get(PhotoEntryKeys.DOWNLOAD_FILE_SIZE, None)
 
-    # Throw on failure, as further writes are likely to fail.
-    write_buffer(path, data)
-    _update_photo_entry(path, directory, photo, did_update_exif)
+    if size is not None and file.size != size:
+        return None
 
-    return photo
+    digest = photo.get(PhotoEntryKeys.DOWNLOAD_FILE_HASH, None)
+    mtime = photo.get(PhotoEntryKeys.DOWNLOAD_FILE_MTIME, None)
+
+    # Re-hash files modified since their hash was recorded, which still requires no requests.
+    if digest is not None and file.mtime != mtime:
+        if await run_in_process(hash_file, file.path) != digest:
+            return None
+
+    return file
+
+async def _record_present_file(directory, photo, file):
+    """Updates the photo entry for a file that is already present, hashing it if no hash is recorded,
+    e.g. after the directory is recreated, so that it is deduplicated on upload."""
+
+    if PhotoEntryKeys.DOWNLOAD_FILE_HASH not in photo:
+        photo[PhotoEntryKeys.DOWNLOAD_FILE_HASH] = await run_in_process(hash_file, file.path)
+
+    photo[PhotoEntryKeys.DOWNLOAD_FILE_PATH] = str(file.path)
+    photo[PhotoEntryKeys.DOWNLOAD_FILE_SIZE] = file.size
+    photo[PhotoEntryKeys.DOWNLOAD_FILE_MTIME] = file.mtime
+
+    write_photo_data(directory, photo)
 
 def _get_download_path(root_path, directory, filename):
     """Returns the download file path for the photo given `root_path` and `directory`."""
@@ -115,21 +172,19 @@ def _get_download_filename(photo, url):
 
     return Path(f'{name}{extension}')
 
-def _update_photo_entry(path, directory, photo, did_update_exif):
+def _update_photo_entry(directory, photo, downloaded_file):
     """Updates the photo entry on a successful download."""
 
-    photo[PhotoEntryKeys.DOWNLOAD_FILE_PATH] = str(path)
+    photo[PhotoEntryKeys.DOWNLOAD_FILE_PATH] = str(downloaded_file.path)
+    photo[PhotoEntryKeys.DOWNLOAD_FILE_SIZE] = downloaded_file.size
+    photo[PhotoEntryKeys.DOWNLOAD_FILE_HASH] = downloaded_file.digest
+    photo[PhotoEntryKeys.DOWNLOAD_FILE_MTIME] = downloaded_file.path.stat().st_mtime_ns
 
-    if did_update_exif:
+    if downloaded_file.did_update_exif:
         photo[PhotoEntryKeys.DID_UPDATE_EXIF] = True
 
     write_photo_data(directory, photo)
 
-def _is_media_video(photo):
-    """Returns a boolean indicating whether the media item is a video."""
-
-    return photo['media'] == 'video'
-
 def _parse_extension_from_url(url):
     """Returns the extension (e.g. .jpg or .mov) from `url`, assuming that `url` is well-formed."""
 
@@ -141,40 +196,37 @@ def _parse_extension_from_url(url):
 def _is_directory_photostream(directory):
     """Returns a boolean indicating whether `directory` is the photostream."""
 
-    return directory == 'photostream'
-
-def _get_downloaded_count(responses):
-    """Returns a tuple with the number of photos downloaded and attempted."""
-
-    num_downloaded = len([r for r in responses if r is not None])
-    num_attempted = len(responses)
-
-    return num_downloaded, num_attempted
+    return directory == PHOTOSTREAM_DIRECTORY
 
-def _print_init(requests):
+def _print_init(num_pending):
     """Prints a download initiation message."""
 
     print_separator()
     print_timestamped(
-        'Beginning download for {} remaining item(s).'.format(len(requests))
+        'Beginning download for {} remaining item(s).'.format(num_pending)
     )
 
-def _print_batch_summary(responses):
+def _print_progress(counts):
     """Prints an intermediate download summary."""
 
-    num_downloaded, num_attempted = _get_downloaded_count(responses)
+    num_downloaded, num_attempted = counts
 
     print_separator()
     print_timestamped(
         'Downloaded {} of {} item(s).'.format(num_downloaded, num_attempted)
     )
 
-def _print_summary(responses):
+def _print_summary(counts, retry_queue, num_present):
     """Prints a final download summary."""
 
-    num_downloaded, num_attempted = _get_downloaded_count(responses)
+    num_downloaded, num_attempted = counts
 
     print_separator()
+    retry_queue.print_dead_letters(lambda item: 'photo {}'.format(item[1]['id']))
     print_timestamped(
-        'Downloaded {} of {} remaining item(s).'.format(num_downloaded, num_attempted)
+        'Downloaded {} of {} remaining item(s), of which {} were already present.'.format(
+            num_downloaded,
+            num_attempted,
+            num_present,
+        )
     )
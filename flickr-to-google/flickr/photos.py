@@ -1,86 +1,182 @@
-import os
+import math
 import asyncio
 
-from .query import query_all_paginated, query, query_chunked
+from .query import iterate_pages, query, get_concurrency
 from .config import read_user_id
 from common.log import print_timestamped, print_separator
+from common.retry import RetryQueue
 from common.directory import (
-    get_outputs_path,
-    get_directory_path,
+    count_photos,
+    iterate_photos,
+    read_photos_data,
     write_photo_data,
-    read_photo_data,
+    write_photos_data,
 )
+from .constants import QUERIES_PER_PAGE, PHOTO_LISTING_EXTRAS, PHOTO_IDENTIFIER_EXTRAS
 from .api import get_flickr_instance, init as init_flickr_api
 
-async def query_photo_identifiers():
-    """Queries and returns a list of photo identifiers."""
+async def query_photo_identifiers(min_upload_date=None):
+    """Queries and returns a list of `(photo_id, date_upload)` tuples, for the photos uploaded at or
+    after `min_upload_date` if set."""
+
+    photo_identifiers = []
+
+    async for page_identifiers in iterate_photo_identifier_pages(min_upload_date=min_upload_date):
+        photo_identifiers += page_identifiers
+
+    return photo_identifiers
+
+async def iterate_photo_identifier_pages(start_page=1, min_upload_date=None):
+    """Yields a list of `(photo_id, date_upload)` tuples for each page of photos from `start_page`,
+    for the photos uploaded at or after `min_upload_date` if set."""
 
     user_id = read_user_id()
     flickr = get_flickr_instance()
 
-    async def page_handler(query):
-        page_response = await asyncio.create_task(query)
-        photos = page_response['photos']['photo']
+    kwargs = {}
 
-        return [photo['id'] for photo in photos]
+    if min_upload_date is not None:
+        kwargs['min_upload_date'] = min_upload_date
 
-    return await query_all_paginated(
+    pages = iterate_pages(
         flickr.people.getPhotos,
-        page_handler,
+        start_page,
         user_id=user_id,
+        extras=PHOTO_IDENTIFIER_EXTRAS,
+        **kwargs
     )
 
+    async for page_response in pages:
+        photos = page_response['photos']['photo']
+
+        yield [(photo['id'], int(photo['dateupload'])) for photo in photos]
+
 async def query_photo_data():
     """Queries all remaining photo fields and updates the directory."""
 
     init_flickr_api()
 
-    requests = _get_requests()
-    _print_init(requests)
-    responses = await query_chunked(requests, _print_download_proportion)
-    _print_summary(responses)
+    num_pending = count_photos(is_populated=False)
+    num_listed = 0
 
-    return _get_proportion_downloaded(responses)
+    if _is_listing_query_efficient(num_pending):
+        num_listed = await _query_listed_photo_data(num_pending)
+        num_pending = count_photos(is_populated=False)
 
-def _get_requests():
-    """Returns a list of requests with photos to populate."""
+    _print_init(num_pending)
 
-    requests = []
+    retry_queue = RetryQueue(
+        _query_photo_data,
+        get_concurrency(),
+        progress_handler=_print_download_proportion,
+    )
 
-    _, directories, _ = next(os.walk(get_outputs_path()))
-    for directory in directories:
+    num_succeeded, num_attempted = await retry_queue.run(iterate_photos(is_populated=False))
+    counts = (num_succeeded + num_listed, num_attempted + num_listed)
 
-        _, _, filenames = next(os.walk(get_directory_path(directory)))
-        for filename in filenames:
-            if filename == 'metadata.json':
-                continue
+    _print_summary(counts, retry_queue)
 
-            photo = read_photo_data(directory, filename)
+    return counts
 
-            if len(photo.keys()) > 1:
-                continue
+def _is_listing_query_efficient(num_pending):
+    """Returns a boolean indicating whether populating from the paginated photo listing takes fewer
+    queries than the two queries required per pending photo."""
 
-            requests.append(_query_photo_data(directory, photo['id']))
+    num_pages = math.ceil(count_photos() / QUERIES_PER_PAGE)
 
-    return requests
+    return num_pages < 2 * num_pending
 
-async def _query_photo_data(directory, photo_id):
-    """Queries a photo's data and updates its data entry."""
+async def _query_listed_photo_data(num_pending):
+    """Populates pending photos from the paginated photo listing with extra fields, and returns the
+    number of populated photos. Photos that cannot be populated this way, such as videos, are left
+    to be queried individually, as are those on the remaining pages if a page fails."""
 
-    try:
-        [url, metadata] = await asyncio.gather(
-            _query_photo_source(photo_id),
-            _query_photo_metadata(photo_id),
-        )
+    user_id = read_user_id()
+    flickr = get_flickr_instance()
 
-        photo = _combine_photo_fields(url, metadata)
-        write_photo_data(directory, photo)
+    _print_listing_init(num_pending)
 
-        return photo
+    pages = iterate_pages(
+        flickr.people.getPhotos,
+        user_id=user_id,
+        extras=PHOTO_LISTING_EXTRAS,
+    )
+
+    num_populated = 0
+
+    try:
+        async for page_response in pages:
+            num_populated += _populate_listed_photos(page_response['photos']['photo'])
     except Exception as err:
-        print(err)
+        # Each page is written as it arrives, so only the unlisted photos are left pending.
+        _print_listing_error(err)
+
+    _print_listing_summary(num_populated)
+
+    return num_populated
+
+def _populate_listed_photos(listed_photos):
+    """Populates the pending entries for a page of listed photos, and returns the number of photos
+    populated."""
+
+    # Look up the entries of each page as it arrives, rather than holding every pending entry.
+    entries = read_photos_data([listed_photo['id'] for listed_photo in listed_photos])
+    directories = {}
+
+    for listed_photo in listed_photos:
+        entry = entries.get(listed_photo['id'], None)
+
+        # Skip photos outside the directory, and those populated already.
+        if entry is None or 'url' in entry[1]:
+            continue
+
+        directory, photo = entry
+        fields = _parse_listed_photo(listed_photo)
+
+        # Update the skeleton entry, which records the photo's albums.
+        if fields is not None:
+            photo.update(fields)
+            directories.setdefault(directory, []).append(photo)
+
+    for directory, photos in directories.items():
+        write_photos_data(directory, photos)
+
+    return sum(len(photos) for photos in directories.values())
+
+def _parse_listed_photo(listed_photo):
+    """Returns a photo entry from a photo listing with extra fields, or `None` if the listing does
+    not identify the original file."""
+
+    # The original URL for a video is a still frame, so query its sizes individually instead.
+    if listed_photo['media'] == 'video' or 'url_o' not in listed_photo:
         return None
 
+    photo = {}
+
+    photo['id'] = listed_photo['id']
+    photo['title'] = listed_photo['title']
+    photo['description'] = listed_photo['description']['_content']
+    photo['posted'] = listed_photo['dateupload']
+    photo['media'] = listed_photo['media']
+    photo['url'] = listed_photo['url_o']
+
+    return photo
+
+async def _query_photo_data(item):
+    """Queries the data for a `(directory, photo)` item and updates its data entry."""
+
+    directory, photo = item
+
+    [url, metadata] = await asyncio.gather(
+        _query_photo_source(photo['id']),
+        _query_photo_metadata(photo['id']),
+    )
+
+    photo.update(_combine_photo_fields(url, metadata))
+    write_photo_data(directory, photo)
+
+    return photo
+
 async def _query_photo_source(photo_id):
     """Queries for a photo's source and returns the URL of the original file."""
 
@@ -156,33 +252,48 @@ def _combine_photo_fields(url, metadata):
 
     return data
 
-def _print_init(requests):
+def _print_init(num_pending):
     """Prints an initialization message with a timestamp."""
 
     print_separator()
     print_timestamped(
-        'Beginning to download metadata for {} photo(s).'.format(len(requests))
+        'Beginning to download metadata for {} photo(s).'.format(num_pending)
+    )
+
+def _print_listing_init(num_pending):
+    """Prints a message on populating photos from the photo listing."""
+
+    print_separator()
+    print_timestamped(
+        'Listing all photos to populate {} photo(s).'.format(num_pending)
     )
 
-def _get_proportion_downloaded(responses):
-    """Returns a `(num_succeeded, num_attempted)` tuple of the proportion of photos downloaded."""
+def _print_listing_error(err):
+    """Prints a message on a failed page of the photo listing."""
+
+    print_timestamped(
+        'Stopped listing photos after an error, querying the rest individually: {}'.format(err)
+    )
 
-    num_succeeded = len([r for r in responses if r is not None])
-    num_attempted = len(responses)
+def _print_listing_summary(num_populated):
+    """Prints a summary on populating photos from the photo listing."""
 
-    return (num_succeeded, num_attempted)
+    print_timestamped(
+        'Populated {} photo(s) from the listing.'.format(num_populated)
+    )
 
-def _print_download_proportion(responses):
-    """Prints a download proportion for `responses`."""
+def _print_download_proportion(counts):
+    """Prints a download proportion for a `(num_succeeded, num_attempted)` tuple."""
 
-    num_succeeded, num_attempted = _get_proportion_downloaded(responses)
+    num_succeeded, num_attempted = counts
 
     print_timestamped(
         f'Downloaded photo data for {num_succeeded} of {num_attempted} image(s).'
     )
 
-def _print_summary(responses):
+def _print_summary(counts, retry_queue):
     """Prints a summary on download completion."""
 
     print_separator()
-    _print_download_proportion(responses)
+    retry_queue.print_dead_letters(lambda item: 'photo {}'.format(item[1]['id']))
+    _print_download_proportion(counts)
@@ -1,23 +1,27 @@
-import asyncio
-
-from .query import query_all_paginated, query, query_chunked
+from .query import query_all_paginated, iterate_pages, query_concurrently
 from .config import read_user_id
 from common.log import print_timestamped
 from .api import get_flickr_instance
 
-async def query_photosets():
-    """Queries for all photosets and returns a list of photoset objects."""
+async def query_photosets(albums=None):
+    """Queries for all photosets and returns a list of photoset objects. If `albums`, a dictionary of
+    the photoset objects already known by ID, is given, the photos are only queried for photosets
+    that are new or whose count or update date has changed, and known fields are preserved."""
 
     user_id = read_user_id()
     flickr = get_flickr_instance()
 
-    async def page_handler(query):
-        response = await asyncio.create_task(query)
+    albums = albums or {}
+
+    async def page_handler(response):
         photosets = response['photosets']['photoset']
 
-        queries = [_query_photoset_data(photoset) for photoset in photosets]
+        queries = [
+            query_photoset_data(photoset, albums.get(photoset['id'], None))
+            for photoset in photosets
+        ]
 
-        return await query_chunked(queries, _print_chunk_summary)
+        return await query_concurrently(queries, _print_progress)
 
     return await query_all_paginated(
         flickr.photosets.getList,
@@ -25,13 +29,35 @@ async def query_photosets():
         user_id=user_id
     )
 
-async def _query_photoset_data(photoset):
-    """Queries for a particular photoset's information and returns a dictionary data object."""
+async def iterate_photoset_pages(start_page=1):
+    """Yields the list of photoset listings, without their photos, for each page of photosets from
+    `start_page`."""
+
+    user_id = read_user_id()
+    flickr = get_flickr_instance()
+
+    async for response in iterate_pages(flickr.photosets.getList, start_page, user_id=user_id):
+        yield response['photosets']['photoset']
+
+async def query_photoset_data(photoset, album=None):
+    """Queries for a particular photoset's information and returns a dictionary data object, reusing
+    the photos of the known `album` if the photoset is unchanged."""
 
     metadata = _parse_photoset_metadata(photoset)
-    photo_ids = await _query_photoset_photos(photoset['id'])
 
-    return _combine_photoset_fields(metadata, photo_ids)
+    if album is None:
+        photo_ids = await _query_photoset_photos(photoset['id'])
+
+        return _combine_photoset_fields(metadata, photo_ids)
+
+    is_changed = any(album.get(key, None) != metadata[key] for key in ['count', 'updated'])
+
+    if is_changed:
+        photo_ids = await _query_photoset_photos(photoset['id'])
+    else:
+        photo_ids = album['photo_ids']
+
+    return _combine_photoset_fields({**album, **metadata}, photo_ids)
 
 def _parse_photoset_metadata(photoset):
     """Extracts the relevant metadata fields from a photoset response object."""
@@ -41,6 +67,8 @@ def _parse_photoset_metadata(photoset):
     metadata['id'] = photoset['id']
     metadata['title'] = photoset['title']['_content']
     metadata['created'] = photoset['date_create']
+    metadata['updated'] = photoset['date_update']
+    metadata['count'] = int(photoset['photos']) + int(photoset['videos'])
 
     return metadata
 
@@ -50,8 +78,7 @@ async def _query_photoset_photos(photoset_id):
     user_id = read_user_id()
     flickr = get_flickr_instance()
 
-    async def page_handler(query):
-        response = await asyncio.create_task(query)
+    async def page_handler(response):
         photo_ids = [photo['id'] for photo in response['photoset']['photo']]
 
         return photo_ids
@@ -71,8 +98,8 @@ def _combine_photoset_fields(metadata, photo_ids):
 
     return data
 
-def _print_chunk_summary(responses):
-    """Prints a summary for each chunk of downloading."""
+def _print_progress(responses):
+    """Prints a summary of the photoset data downloaded so far."""
 
     print_timestamped(
         'Downloaded photoset data for {} album(s).'.format(len(responses))
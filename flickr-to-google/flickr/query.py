@@ -1,58 +1,148 @@
+import re
 import httpx
 import json
 import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from .constants import Endpoints, QUERIES_PER_PAGE, REQUESTS_BATCH_SIZE
+from flickrapi.exceptions import FlickrError
 
-async def query_all_paginated(method, page_handler, **kwargs):
-    """Queries all pages and applies `page_handler` to each one, returning a flattened list of the responses."""
+from .constants import (
+    Endpoints,
+    QUERIES_PER_PAGE,
+    REQUESTS_BATCH_SIZE,
+    QUERIES_PER_SECOND,
+    QUERIES_BURST,
+)
+from common.concurrency import gather_bounded
+from common.rate_limit import RateLimiter, THROTTLING_STATUS_CODES
+from common.retry import TransientError, PermanentError, is_transient_status
+
+# Flickr API error codes for failures that are worth retrying:
+# - https://www.flickr.com/services/api/flickr.photos.getInfo.html
+TRANSIENT_ERROR_CODES = [
+    105, # Service currently unavailable
+    106, # Write operation failed
+]
+
+# `flickrapi` calls are blocking, so run them on a dedicated pool sized to the query concurrency.
+concurrency = REQUESTS_BATCH_SIZE
+executor = None
+
+rate_limiter = RateLimiter('flickr-api', QUERIES_PER_SECOND, QUERIES_BURST)
+
+def configure_concurrency(limit):
+    """Sets the maximum number of concurrent queries, which must be called before the first query."""
+
+    global concurrency
+
+    assert executor is None
+
+    concurrency = limit
+
+def get_concurrency():
+    """Returns the maximum number of concurrent queries."""
+
+    return concurrency
 
-    page_limit = await _query_page_limit(
-        method,
-        per_page=QUERIES_PER_PAGE,
-        **kwargs
-    )
+def configure_rate_limit(rate):
+    """Sets the maximum number of queries per second."""
 
-    # Repeat the original page query here, for simplicity.
+    rate_limiter.configure(rate=rate)
 
-    queries = [
-        query(
-            method,
-            page=page,
-            per_page=QUERIES_PER_PAGE,
-            **kwargs
-        ) for page in range(1, page_limit + 1)
-    ]
+def get_executor():
+    """Returns the thread pool used to run queries, creating it on first use."""
 
-    results = await query_chunked([page_handler(query) for query in queries])
+    global executor
+
+    if executor is None:
+        executor = ThreadPoolExecutor(
+            max_workers=concurrency,
+            thread_name_prefix='flickr-query',
+        )
+
+    return executor
+
+async def query_all_paginated(method, page_handler, **kwargs):
+    """Queries all pages and awaits `page_handler` with each response as it arrives, returning a
+    flattened list of the handled responses."""
+
+    results = []
+
+    async for response in iterate_pages(method, **kwargs):
+        results.append(await page_handler(response))
 
     return _flatten(results)
 
+async def iterate_pages(method, start_page=1, **kwargs):
+    """Yields the response for each page of a paginated query from `start_page`, in order. The first
+    page is yielded as soon as it arrives and provides the page limit; the remaining pages are then
+    queried concurrently, up to the query concurrency, ahead of the consumer."""
+
+    def query_page(page):
+        return asyncio.create_task(
+            query(
+                method,
+                page=page,
+                per_page=QUERIES_PER_PAGE,
+                **kwargs
+            )
+        )
+
+    response = await query_page(start_page)
+    page_limit = _parse_page_limit(response)
+
+    # Pages beyond the limit repeat the last page, e.g. when resuming a completed query.
+    if start_page > max(page_limit, 1):
+        return
+
+    yield response
+
+    pages = iter(range(start_page + 1, page_limit + 1))
+    window = deque(query_page(page) for _, page in zip(range(concurrency), pages))
+
+    try:
+        while len(window) > 0:
+            response = await window.popleft()
+
+            page = next(pages, None)
+
+            if page is not None:
+                window.append(query_page(page))
+
+            yield response
+    finally:
+        # Stop querying ahead if the consumer stops early or a page fails.
+        for task in window:
+            task.cancel()
+
 async def query(method, **kwargs):
     """Performs an API query and returns the JSON response."""
 
     loop = asyncio.get_running_loop()
 
-    return await loop.run_in_executor(None, lambda: method(**kwargs))
+    await rate_limiter.acquire()
 
-async def query_chunked(queries, chunk_handler=None):
-    """Executes the queries in chunks to avoid creating excess requests."""
+    try:
+        response = await loop.run_in_executor(get_executor(), lambda: method(**kwargs))
+    except FlickrError as err:
+        if _is_throttling_error(err):
+            rate_limiter.on_throttled()
 
-    responses = []
+        raise _classify_error(err) from err
 
-    # Technically, this should use a semaphore; but, use batches for timestamping.
-    for i in range(0, len(queries), REQUESTS_BATCH_SIZE):
-        chunk_responses = await asyncio.gather(*queries[i:i + REQUESTS_BATCH_SIZE])
-        if chunk_handler is not None:
-            chunk_handler(chunk_responses)
-        responses += chunk_responses
+    rate_limiter.on_success()
 
-    return responses
+    return response
 
-async def _query_page_limit(method, **kwargs):
-    """Queries the given request and returns the paginated page limit."""
+async def query_concurrently(queries, progress_handler=None):
+    """Executes the queries within a sliding window to avoid creating excess requests, calling
+    `progress_handler` with the completed responses as they accumulate."""
 
-    response = await query(method, **kwargs)
+    return await gather_bounded(queries, concurrency, progress_handler)
+
+def _parse_page_limit(response):
+    """Returns the paginated page limit of a query response."""
 
     # Find the first member that is a dictionary with key `pages`, then return the value:
     key = 'pages'
@@ -68,6 +158,35 @@ async def _query_page_limit(method, **kwargs):
 
     raise Exception('Page limit requested for non-paginated request')
 
+def _classify_error(err):
+    """Returns a transient or permanent error corresponding to the Flickr error `err`."""
+
+    if err.code is not None:
+        is_transient = err.code in TRANSIENT_ERROR_CODES
+    else:
+        status_code = _get_status_code(err)
+        is_transient = status_code is None or is_transient_status(status_code)
+
+    error_type = TransientError if is_transient else PermanentError
+
+    return error_type(str(err))
+
+def _is_throttling_error(err):
+    """Returns a boolean indicating whether the Flickr error `err` indicates excess queries."""
+
+    return _get_status_code(err) in THROTTLING_STATUS_CODES
+
+def _get_status_code(err):
+    """Returns the HTTP status code of the Flickr error `err`, or `None` if it is an API error."""
+
+    if err.code is not None:
+        return None
+
+    # Errors without codes are raised for HTTP failures, e.g. "Status code 502 received".
+    match = re.search(r'Status code (\d+)', str(err))
+
+    return None if match is None else int(match.group(1))
+
 def _flatten(l):
     """Flattens a list `l`."""
 
@@ -1,17 +1,31 @@
 import json
 import asyncio
-import os
-from pathlib import Path
 
 from .rest import post
 from .authenticate import authenticate_user
-from .constants import Endpoints, PhotoEntryKeys
+from .constants import (
+    Endpoints,
+    PhotoEntryKeys,
+    ALBUM_CREATIONS_PER_SECOND,
+    CONTENT_BATCH_LIMIT,
+)
 from common.directory import (
+    read_albums,
     read_album_metadata,
     write_album_metadata,
-    get_outputs_path,
+    write_photos_data,
 )
 from common.log import print_timestamped, print_separator
+from common.rate_limit import RateLimiter
+from common.retry import RetryQueue, PermanentError, raise_for_response
+
+album_rate_limiter = RateLimiter('google-albums', ALBUM_CREATIONS_PER_SECOND)
+
+# Albums are created one at a time, as Google Photos disallows concurrent writes.
+album_lock = asyncio.Lock()
+
+# Tasks resolving to the Google Photos album ID of each Flickr album requested during this run:
+album_tasks = {}
 
 async def create_albums():
     """Attempts to create all remaining albums and updates the directory files accordingly, including
@@ -19,55 +33,129 @@ async def create_albums():
 
     authenticate_user()
 
-    requests = _get_requests()
+    albums = read_albums(is_created=False)
 
-    _print_init(requests)
+    _print_init(albums)
 
     # Run this synchronously, as Google Photos disallows concurrent writes.
-    # TODO: Should add a delay between batches of requests to avoid triggering rate-limits.
-    responses = [await request for request in requests]
+    # Requests are paced by the rate limiter for album creations.
+    retry_queue = RetryQueue(_create_album, 1)
+    counts = await retry_queue.run(albums)
+
+    _print_summary(counts, retry_queue)
 
-    _print_summary(responses)
+    return counts
 
-    return _get_created_count(responses)
+def start_album_creation(album_id):
+    """Returns a task resolving to the Google Photos album ID of the Flickr album `album_id`,
+    creating the album if it does not exist yet. Tasks are memoized, so that each album is created
+    once; failed tasks are forgotten, so that the next call retries the creation."""
 
-def _get_requests():
-    """Returns a list of unfulfilled album creation requests."""
+    task = album_tasks.get(album_id, None)
 
-    requests = []
+    if task is not None:
+        return task
 
-    outputs_path = get_outputs_path()
-    _, directories, _ = next(os.walk(outputs_path))
+    task = asyncio.create_task(_get_or_create_album(album_id))
+    album_tasks[album_id] = task
 
-    for directory in directories:
-        if directory == 'photostream':
-            continue
+    def on_done(task):
+        if task.cancelled() or task.exception() is not None:
+            del album_tasks[album_id]
 
-        album = read_album_metadata(directory)
+    task.add_done_callback(on_done)
 
-        if PhotoEntryKeys.GOOGLE_ALBUM_ID in album:
-            continue
+    return task
 
-        requests.append(_create_album(album))
+async def get_google_album_id(album_id):
+    """Returns the Google Photos album ID of the Flickr album `album_id`, creating the album if it
+    does not exist yet, and raising on failure."""
 
-    return requests
+    return await start_album_creation(album_id)
+
+async def _get_or_create_album(album_id):
+    """Returns the recorded Google Photos album ID of `album_id`, or creates the album."""
+
+    album = read_album_metadata(album_id)
+    photo_album_id = album.get(PhotoEntryKeys.GOOGLE_ALBUM_ID, None)
+
+    if photo_album_id is not None:
+        return photo_album_id
+
+    async with album_lock:
+        return await _create_album(album)
 
 async def _create_album(album):
     """Attempts to create `album` and updates its directory file."""
 
     payload = _create_request_payload(album)
-    response = await post(Endpoints.ALBUMS, data=payload)
 
-    if response is None:
-        return None
+    await album_rate_limiter.acquire()
+    response = await post(Endpoints.ALBUMS, content=payload)
+
+    raise_for_response(response)
 
     photo_album_id = _parse_album_id(response)
 
-    if photo_album_id is not None:
-        _update_album_entry(album, photo_album_id)
+    if photo_album_id is None:
+        raise PermanentError('No album ID in response')
+
+    _update_album_entry(album, photo_album_id)
 
     return photo_album_id
 
+async def add_media_items(album_id, media_ids):
+    """Adds the media items `media_ids`, at most `CONTENT_BATCH_LIMIT`, to the Google Photos album
+    `album_id`, raising on failure."""
+
+    url = f'{Endpoints.ALBUMS}/{album_id}:batchAddMediaItems'
+    response = await post(url, json={'mediaItemIds': media_ids})
+
+    raise_for_response(response)
+
+async def add_album_members(members, on_added):
+    """Adds media items to albums in batches of at most `CONTENT_BATCH_LIMIT`, where `members` maps
+    each Flickr album ID, or `None` for no album, to a list of `(directory, photo, media_id)` items.
+    Albums are created if needed. Each added batch is passed to `on_added(album_id, batch)` before
+    its photos are written, and the number of items added is returned."""
+
+    batches = [
+        (album_id, items[i:i + CONTENT_BATCH_LIMIT])
+        for album_id, items in members.items()
+        for i in range(0, len(items), CONTENT_BATCH_LIMIT)
+    ]
+
+    async def add_batch(item):
+        album_id, batch = item
+
+        # Items with no album only need to be recorded.
+        if album_id is not None:
+            google_album_id = await get_google_album_id(album_id)
+            media_ids = list(dict.fromkeys(media_id for _, _, media_id in batch))
+            await add_media_items(google_album_id, media_ids)
+
+        on_added(album_id, batch)
+
+        directories = {}
+
+        for directory, photo, _ in batch:
+            directories.setdefault(directory, []).append(photo)
+
+        for directory, photos in directories.items():
+            write_photos_data(directory, photos)
+
+        return batch
+
+    # Run this synchronously, as Google Photos disallows concurrent writes.
+    retry_queue = RetryQueue(add_batch, 1)
+    await retry_queue.run(batches)
+
+    retry_queue.print_dead_letters(
+        lambda item: 'batch of {} photo(s) for album {}'.format(len(item[1]), item[0])
+    )
+
+    return sum(len(batch) for batch in retry_queue.results)
+
 def _update_album_entry(album, photo_album_id):
     """Updates the album's metadata file given the created `photo_album_id`."""
 
@@ -92,29 +180,21 @@ def _parse_album_id(response):
 
     return response.json().get('id', None)
 
-def _print_init(requests):
+def _print_init(albums):
     """Prints an upload initiation message."""
 
     print_separator()
     print_timestamped(
-        'Beginning to create {} remaining album(s).'.format(len(requests))
+        'Beginning to create {} remaining album(s).'.format(len(albums))
     )
 
-def _print_summary(responses):
+def _print_summary(counts, retry_queue):
     """Prints a final upload summary."""
 
-    num_created, num_attempted = _get_created_count(responses)
+    num_created, num_attempted = counts
 
     print_separator()
+    retry_queue.print_dead_letters(lambda album: 'album {}'.format(album['id']))
     print_timestamped(
         'Created {} out of {} remaining album(s).'.format(num_created, num_attempted)
     )
-
-def _get_created_count(responses):
-    """Returns a tuple with the number of albums created and attempted."""
-
-    num_created = len([r for r in responses if r is not None])
-    num_attempted = len(responses)
-
-    return num_created, num_attempted
-
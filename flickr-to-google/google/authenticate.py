@@ -15,6 +15,18 @@ SCOPES = [
     "https://www.googleapis.com/auth/photoslibrary.readonly",
 ]
 
+def read_credentials():
+    """Returns the cached OAuth credentials."""
+
+    token_path = get_oauth_token_path()
+    return Credentials.from_authorized_user_file(token_path, SCOPES)
+
+def refresh_credentials(creds):
+    """Refreshes `creds` in-place and updates the cached token."""
+
+    creds.refresh(Request())
+    _write_credentials(creds)
+
 def authenticate_user():
     creds = None
 
@@ -35,5 +47,12 @@ def authenticate_user():
             )
             creds = flow.run_local_server(port=0)
 
+    _write_credentials(creds)
+
+def _write_credentials(creds):
+    """Writes `creds` to the cached token file."""
+
+    token_path = get_oauth_token_path()
+
     with open(token_path, 'w') as token:
         token.write(creds.to_json())
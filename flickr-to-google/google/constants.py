@@ -7,9 +7,51 @@ class Endpoints(StrEnum):
 
 class PhotoEntryKeys(StrEnum):
     GOOGLE_UPLOAD_TOKEN = 'google-upload-token'
+    GOOGLE_UPLOAD_TOKEN_ISSUED = 'google-upload-token-issued'
+    GOOGLE_UPLOAD_URL = 'google-upload-url'
+    GOOGLE_UPLOAD_OFFSET = 'google-upload-offset'
     GOOGLE_ALBUM_ID = 'google-album-id'
     GOOGLE_MEDIA_ID = 'google-media-id'
+    GOOGLE_ADDED_ALBUM_IDS = 'google-added-album-ids'
+    GOOGLE_CREATED_WITHOUT_ALBUM = 'google-created-without-album'
     DID_UPDATE_EXIF = 'did_update_exif'
+    DOWNLOAD_FILE_PATH = 'image_path'
+    DOWNLOAD_FILE_SIZE = 'image_size'
+    DOWNLOAD_FILE_HASH = 'image_hash'
 
 REQUESTS_BATCH_SIZE = 10
 CONTENT_BATCH_LIMIT = 50
+
+# Upload pipeline settings; byte uploads run concurrently and feed a single `batchCreate` committer:
+UPLOAD_WORKERS = REQUESTS_BATCH_SIZE
+UPLOAD_QUEUE_SIZE = 2 * CONTENT_BATCH_LIMIT
+
+# Upload tokens are valid for a day after issue; reuse them for item creation within this window:
+# - https://developers.google.com/photos/library/guides/upload-media
+UPLOAD_TOKEN_TTL_SECONDS = 23 * 60 * 60
+
+# Files of at least this size are uploaded in chunks over a resumable session, which is persisted
+# so that an interrupted upload continues from the last committed chunk:
+# - https://developers.google.com/photos/library/guides/resumable-uploads
+RESUMABLE_UPLOAD_THRESHOLD = 64 * 1024 * 1024
+RESUMABLE_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Connection pool settings for the shared Google Photos client:
+MAX_CONNECTIONS = 10
+MAX_KEEPALIVE_CONNECTIONS = 10
+KEEPALIVE_EXPIRY_SECONDS = 60
+REQUEST_TIMEOUT_SECONDS = 60
+
+# Request rates and the daily quota for the Google Photos API, which does not count byte uploads:
+# - https://developers.google.com/photos/library/guides/api-limits-quotas
+API_REQUESTS_PER_SECOND = 10
+API_REQUESTS_BURST = REQUESTS_BATCH_SIZE
+API_DAILY_QUOTA = 10000
+UPLOAD_REQUESTS_PER_SECOND = 10
+UPLOAD_REQUESTS_BURST = REQUESTS_BATCH_SIZE
+
+# Albums are created on demand during uploads, paced separately so that they do not crowd out items:
+ALBUM_CREATIONS_PER_SECOND = 1
+
+# Refresh the OAuth token when it is within this window of expiring:
+TOKEN_REFRESH_MARGIN_SECONDS = 5 * 60
@@ -0,0 +1,52 @@
+from .albums import add_album_members
+from .constants import PhotoEntryKeys
+from common.directory import get_pending_album_ids, read_photos
+from common.log import print_timestamped, print_separator
+
+# Photos in several Flickr albums are uploaded once, into the album of their directory, then added to
+# the remaining albums as the same media item.
+
+async def add_photos_to_albums():
+    """Adds each uploaded photo to the albums it belongs to besides its own directory, and returns the
+    number of album memberships added and attempted."""
+
+    members = {}
+
+    for directory, photo in read_photos(is_uploaded=True, is_in_albums=False):
+        for album_id in get_pending_album_ids(directory, photo):
+            item = (directory, photo, photo[PhotoEntryKeys.GOOGLE_MEDIA_ID])
+            members.setdefault(album_id, []).append(item)
+
+    num_attempted = sum(len(items) for items in members.values())
+
+    if num_attempted == 0:
+        return 0, 0
+
+    _print_init(num_attempted)
+
+    def on_added(album_id, batch):
+        for _, photo, _ in batch:
+            photo.setdefault(PhotoEntryKeys.GOOGLE_ADDED_ALBUM_IDS, []).append(album_id)
+
+    num_added = await add_album_members(members, on_added)
+
+    _print_summary((num_added, num_attempted))
+
+    return num_added, num_attempted
+
+def _print_init(num_attempted):
+    """Prints an album membership initiation message."""
+
+    print_separator()
+    print_timestamped(
+        'Adding uploaded photos to {} remaining album membership(s).'.format(num_attempted)
+    )
+
+def _print_summary(counts):
+    """Prints a final album membership summary."""
+
+    num_added, num_attempted = counts
+
+    print_timestamped(
+        'Added {} out of {} album membership(s).'.format(num_added, num_attempted)
+    )
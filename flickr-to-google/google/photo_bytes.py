@@ -1,44 +1,249 @@
+import time
 import httpx
 import mimetypes
-import asyncio
 from pathlib import Path
 
 from .rest import post, create_headers
-from .constants import Endpoints, PhotoEntryKeys
-from common.files import write_json_file, read_json_file
-from common.request import download_photo_bytes
+from .constants import (
+    Endpoints,
+    PhotoEntryKeys,
+    UPLOAD_TOKEN_TTL_SECONDS,
+    RESUMABLE_UPLOAD_THRESHOLD,
+    RESUMABLE_CHUNK_SIZE,
+)
+from common.files import (
+    FILE_CHUNK_SIZE,
+    write_json_file,
+    read_json_file,
+    hash_file,
+    read_file_chunks,
+)
+from common.budget import get_byte_budget
+from common.request import stream_photo_with_exif
+from common.processing import run_in_process
+from common.retry import TransientError, raise_for_response
 
 # TODO: Run a linter
 
-async def upload_bytes_batch(batch):
-    """Uploads photo bytes for a list of photos `batch`."""
+async def upload_bytes(photo, checkpoint_handler=None, is_streaming=False):
+    """Uploads the bytes for `photo` and returns the updated entry, raising on failure. Large files
+    are uploaded over a resumable session, whose progress is recorded in `photo` before each call to
+    `checkpoint_handler`. If `is_streaming` is set, the bytes are streamed from Flickr even if the
+    photo has been downloaded. Each upload reserves the bytes it holds in memory against the shared
+    byte budget."""
 
-    photos = await asyncio.gather(
-        *[upload_bytes(photo) for photo in batch]
-    )
+    path = None if is_streaming else await _get_downloaded_file_path(photo)
+
+    if path is None:
+        upload_token = await _upload_stream(photo)
+    elif (size := path.stat().st_size) >= RESUMABLE_UPLOAD_THRESHOLD:
+        # Files on disk are read a chunk at a time, so only the chunk is reserved.
+        async with get_byte_budget().reserve(RESUMABLE_CHUNK_SIZE):
+            upload_token = await _upload_resumable(photo, path, checkpoint_handler)
+    else:
+        async with get_byte_budget().reserve(min(size, FILE_CHUNK_SIZE)):
+            upload_token = await _upload_raw(photo, path)
+
+    photo[PhotoEntryKeys.GOOGLE_UPLOAD_TOKEN] = upload_token
+    photo[PhotoEntryKeys.GOOGLE_UPLOAD_TOKEN_ISSUED] = time.time()
+
+    return photo
+
+def has_valid_upload_token(photo):
+    """Returns a boolean indicating whether `photo` has an upload token that has not expired."""
+
+    if PhotoEntryKeys.GOOGLE_UPLOAD_TOKEN not in photo:
+        return False
+
+    # Tokens recorded without an issue time cannot be trusted to be valid.
+    issued = photo.get(PhotoEntryKeys.GOOGLE_UPLOAD_TOKEN_ISSUED, None)
+
+    return issued is not None and time.time() - issued < UPLOAD_TOKEN_TTL_SECONDS
+
+def clear_upload_token(photo):
+    """Removes the upload token from `photo` in-place, once it is used or rejected."""
+
+    photo.pop(PhotoEntryKeys.GOOGLE_UPLOAD_TOKEN, None)
+    photo.pop(PhotoEntryKeys.GOOGLE_UPLOAD_TOKEN_ISSUED, None)
 
-    return [photo for photo in photos if photo is not None]
+async def _upload_raw(photo, path):
+    """Uploads the file at `path` in a single request and returns the upload token."""
 
-async def upload_bytes(photo):
-    """Uploads the bytes for `photo` and returns an updated entry on success."""
+    headers = _create_headers(photo)
+
+    # Stream the existing download, which has already had its EXIF updated.
+    headers['Content-Length'] = str(path.stat().st_size)
+    content = read_file_chunks(path)
+
+    response = await post(Endpoints.BYTE_UPLOADS, headers, content=content)
+
+    return _read_upload_token(response)
+
+async def _upload_stream(photo):
+    """Pipes the bytes for `photo` from Flickr into a single upload request, without writing them to
+    disk or holding more than a chunk in memory, and returns the upload token."""
 
     headers = _create_headers(photo)
-    _, content, _ = download_photo_bytes(photo)
 
-    if content is None:
+    async with stream_photo_with_exif(photo) as streamed_photo:
+        # Without a declared size, the body is sent with chunked encoding.
+        if streamed_photo.size is not None:
+            headers['Content-Length'] = str(streamed_photo.size)
+
+        response = await post(Endpoints.BYTE_UPLOADS, headers, content=streamed_photo.content)
+
+    if streamed_photo.did_update_exif:
+        photo[PhotoEntryKeys.DID_UPDATE_EXIF] = True
+
+    return _read_upload_token(response)
+
+async def _upload_resumable(photo, path, checkpoint_handler):
+    """Uploads the file at `path` in chunks over a resumable session, continuing any session recorded
+    in `photo`, and returns the upload token."""
+
+    size = path.stat().st_size
+    chunk_size = RESUMABLE_CHUNK_SIZE
+
+    offset = await _query_upload_session(photo)
+
+    if offset is None:
+        upload_url, granularity = await _start_upload_session(photo, size)
+
+        # Chunks other than the last must be a multiple of the session's granularity.
+        if granularity is not None:
+            chunk_size = max(granularity, chunk_size - chunk_size % granularity)
+
+        offset = 0
+
+        photo[PhotoEntryKeys.GOOGLE_UPLOAD_URL] = upload_url
+        photo[PhotoEntryKeys.GOOGLE_UPLOAD_OFFSET] = offset
+        _checkpoint(checkpoint_handler)
+
+    upload_url = photo[PhotoEntryKeys.GOOGLE_UPLOAD_URL]
+
+    while True:
+        end = min(size, offset + chunk_size)
+        command = 'upload, finalize' if end == size else 'upload'
+
+        headers = create_headers(**{
+            'X-Goog-Upload-Command': command,
+            'X-Goog-Upload-Offset': str(offset),
+            'Content-Length': str(end - offset),
+        })
+
+        content = read_file_chunks(path, start=offset, end=end)
+        response = await post(upload_url, headers, content=content)
+
+        if end == size:
+            break
+
+        raise_for_response(response)
+
+        offset = end
+
+        photo[PhotoEntryKeys.GOOGLE_UPLOAD_OFFSET] = offset
+        _checkpoint(checkpoint_handler)
+
+    upload_token = _read_upload_token(response)
+
+    # The session is complete, so it cannot be resumed again.
+    photo.pop(PhotoEntryKeys.GOOGLE_UPLOAD_URL, None)
+    photo.pop(PhotoEntryKeys.GOOGLE_UPLOAD_OFFSET, None)
+
+    return upload_token
+
+async def _start_upload_session(photo, size):
+    """Starts a resumable upload session for `size` bytes and returns its URL and chunk granularity."""
+
+    args = {
+        'X-Goog-Upload-Protocol': 'resumable',
+        'X-Goog-Upload-Command': 'start',
+        'X-Goog-Upload-Raw-Size': str(size),
+        'Content-Length': '0',
+    }
+
+    media_type, _ = mimetypes.guess_type(photo['url'])
+
+    if media_type is not None:
+        args['X-Goog-Upload-Content-Type'] = media_type
+
+    response = await post(Endpoints.BYTE_UPLOADS, create_headers(**args))
+
+    raise_for_response(response)
+
+    upload_url = response.headers.get('X-Goog-Upload-URL', None)
+
+    if upload_url is None:
+        raise TransientError('No upload URL in response')
+
+    granularity = response.headers.get('X-Goog-Upload-Chunk-Granularity', None)
+
+    return upload_url, None if granularity is None else int(granularity)
+
+async def _query_upload_session(photo):
+    """Returns the number of bytes committed to the upload session recorded in `photo`, or `None` if
+    there is no session or it can no longer be resumed."""
+
+    if PhotoEntryKeys.GOOGLE_UPLOAD_URL not in photo:
         return None
 
-    response = await post(Endpoints.BYTE_UPLOADS, headers, data=content)
+    headers = create_headers(**{
+        'X-Goog-Upload-Command': 'query',
+        'Content-Length': '0',
+    })
+
+    response = await post(photo[PhotoEntryKeys.GOOGLE_UPLOAD_URL], headers)
 
     if response is None:
+        raise TransientError('No response received')
+
+    is_active = (
+        response.status_code == 200
+        and response.headers.get('X-Goog-Upload-Status', None) == 'active'
+    )
+
+    if not is_active:
+        photo.pop(PhotoEntryKeys.GOOGLE_UPLOAD_URL, None)
+        photo.pop(PhotoEntryKeys.GOOGLE_UPLOAD_OFFSET, None)
+
         return None
 
-    upload_token = _parse_upload_token(response)
+    # The server's count is authoritative, as a chunk may have been committed without a response.
+    offset = int(response.headers['X-Goog-Upload-Size-Received'])
+    photo[PhotoEntryKeys.GOOGLE_UPLOAD_OFFSET] = offset
+
+    return offset
 
-    if upload_token is not None:
-        photo[PhotoEntryKeys.GOOGLE_UPLOAD_TOKEN] = upload_token
+def _checkpoint(checkpoint_handler):
+    """Calls `checkpoint_handler`, if set, to persist the upload progress."""
 
-        return photo
+    if checkpoint_handler is not None:
+        checkpoint_handler()
+
+async def _get_downloaded_file_path(photo):
+    """Returns the path to the downloaded file for `photo` if it is present and matches the recorded
+    size and hash, or `None` otherwise."""
+
+    if PhotoEntryKeys.DOWNLOAD_FILE_PATH not in photo:
+        return None
+
+    path = Path(photo[PhotoEntryKeys.DOWNLOAD_FILE_PATH])
+
+    if not path.is_file():
+        return None
+
+    # Files downloaded before sizes and hashes were recorded are used as-is.
+    size = photo.get(PhotoEntryKeys.DOWNLOAD_FILE_SIZE, None)
+
+    if size is not None and path.stat().st_size != size:
+        return None
+
+    digest = photo.get(PhotoEntryKeys.DOWNLOAD_FILE_HASH, None)
+
+    if digest is not None and await run_in_process(hash_file, path) != digest:
+        return None
+
+    return path
 
 def _create_headers(photo):
     """Creates HTTP headers for uploading photo bytes."""
@@ -55,10 +260,19 @@ def _create_headers(photo):
 
     return create_headers(**args)
 
+def _read_upload_token(response):
+    """Returns the upload token within `response`, raising if the upload failed."""
+
+    raise_for_response(response)
+
+    upload_token = _parse_upload_token(response)
+
+    if upload_token is None:
+        raise TransientError('No upload token in response')
+
+    return upload_token
+
 def _parse_upload_token(response):
     """Returns the upload token within the response or `None` on failure."""
 
-    if response.status_code == 200:
-        return response.text
-
-    return None
+    return response.text or None
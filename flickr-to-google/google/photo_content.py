@@ -6,15 +6,16 @@ from .constants import (
     Endpoints,
     PhotoEntryKeys,
 )
+from common.retry import raise_for_response
 
 async def upload_content_batch(batch, album_id):
-    """Uploads a batch of photos `batch` and returns a list of uploaded photos, updated in-place."""
+    """Uploads a batch of photos `batch` and returns a list of uploaded photos, updated in-place.
+    Raises if the request fails; photos that fail individually are omitted from the list."""
 
     content = _create_request_payload(album_id, batch)
     response = await post(Endpoints.BATCH_CREATE, json=content)
 
-    if response is None:
-        return None
+    raise_for_response(response)
 
     photos = _get_uploaded_photos(batch, response)
 
@@ -72,10 +73,7 @@ def _get_uploaded_photos(batch, response):
     return photos
 
 def _parse_results(response):
-    """Returns the results for `response` or None on failure."""
-
-    if response.status_code != 200:
-        return []
+    """Returns the results for `response`."""
 
     return response.json()['newMediaItemResults']
 
@@ -0,0 +1,104 @@
+from .albums import add_album_members
+from .constants import PhotoEntryKeys
+from common.directory import PHOTOSTREAM_DIRECTORY, read_media_id, write_media_ids
+from common.log import print_timestamped, print_separator
+
+# Identical images are often uploaded to Flickr several times; upload each distinct file once, keyed
+# by the content hash recorded on download, and add the copies to their albums as the same item.
+
+def partition_duplicates(items, is_using_index=True):
+    """Splits the `(directory, photo)` items into an iterator over those to upload, and a
+    list of duplicates of content that is uploaded already, or by an earlier item; the list is filled
+    lazily as the iterator is consumed. If `is_using_index` is `False`, content uploaded by earlier
+    runs is uploaded again."""
+
+    duplicates = []
+
+    def iterate_originals():
+        digests = set()
+
+        for item in items:
+            _, photo = item
+            digest = photo.get(PhotoEntryKeys.DOWNLOAD_FILE_HASH, None)
+
+            if digest is None:
+                yield item
+                continue
+
+            is_duplicate = (
+                digest in digests
+                or is_using_index and read_media_id(digest) is not None
+            )
+
+            if is_duplicate:
+                duplicates.append(item)
+            else:
+                digests.add(digest)
+                yield item
+
+    return iterate_originals(), duplicates
+
+def index_uploaded_photos(photos):
+    """Records the media IDs of the uploaded `photos` by their content hashes."""
+
+    media_ids = {
+        photo[PhotoEntryKeys.DOWNLOAD_FILE_HASH]: photo[PhotoEntryKeys.GOOGLE_MEDIA_ID]
+        for photo in photos
+        if PhotoEntryKeys.DOWNLOAD_FILE_HASH in photo
+    }
+
+    write_media_ids(media_ids)
+
+async def attach_duplicates(duplicates):
+    """Adds each duplicate to its album as the media item uploaded with the same content, and returns
+    the number of duplicates attached and attempted. Duplicates of content that failed to upload are
+    left pending."""
+
+    members = {}
+
+    for directory, photo in duplicates:
+        media_id = read_media_id(photo[PhotoEntryKeys.DOWNLOAD_FILE_HASH])
+
+        if media_id is None:
+            continue
+
+        # Photostream items are not added to any album, so they only need to be recorded.
+        album_id = None if directory == PHOTOSTREAM_DIRECTORY else directory
+        members.setdefault(album_id, []).append((directory, photo, media_id))
+
+    num_attempted = sum(len(items) for items in members.values())
+
+    if num_attempted == 0:
+        return 0, 0
+
+    _print_init(num_attempted, len(duplicates))
+
+    def on_added(album_id, batch):
+        for _, photo, media_id in batch:
+            photo[PhotoEntryKeys.GOOGLE_MEDIA_ID] = media_id
+
+    num_attached = await add_album_members(members, on_added)
+
+    _print_summary((num_attached, num_attempted))
+
+    return num_attached, num_attempted
+
+def _print_init(num_attempted, num_duplicates):
+    """Prints a deduplication initiation message."""
+
+    print_separator()
+    print_timestamped(
+        'Adding {} of {} duplicate photo(s) as items already uploaded.'.format(
+            num_attempted,
+            num_duplicates,
+        )
+    )
+
+def _print_summary(counts):
+    """Prints a final deduplication summary."""
+
+    num_attached, num_attempted = counts
+
+    print_timestamped(
+        'Added {} out of {} duplicate photo(s).'.format(num_attached, num_attempted)
+    )
@@ -1,162 +1,354 @@
 import asyncio
-import os
-import json
-from pathlib import Path
-from functools import reduce
+from collections import Counter
+from dataclasses import dataclass, field
 
 from .authenticate import authenticate_user
+from .albums import start_album_creation
 from .constants import (
     PhotoEntryKeys,
     CONTENT_BATCH_LIMIT,
-    REQUESTS_BATCH_SIZE,
+    UPLOAD_WORKERS,
+    UPLOAD_QUEUE_SIZE,
 )
+from common.retry import RetryQueue, TransientError
 from common.directory import (
-    get_outputs_path,
-    get_directory_path,
-    read_album_metadata,
+    PHOTOSTREAM_DIRECTORY,
+    count_photos,
+    iterate_photos,
+    read_directories,
     write_photo_data,
-    read_photo_data,
+    write_photos_data,
 )
 from common.log import print_timestamped, print_separator
 from .photo_content import upload_content_batch
-from .photo_bytes import upload_bytes_batch
+from .photo_bytes import upload_bytes, has_valid_upload_token, clear_upload_token
+from .photo_dedup import partition_duplicates, index_uploaded_photos, attach_duplicates
+from .photo_albums import add_photos_to_albums
+
+@dataclass
+class CommitState:
+    """Tracks each directory in the upload pipeline, so that the committer knows when a partial batch
+    can be committed and whether its album has been created."""
+
+    commit_queue: asyncio.Queue
+    num_unresolved: Counter = field(default_factory=Counter)
+    exhausted_directories: set = field(default_factory=set)
+    is_exhausted: bool = False
+    album_tasks: dict = field(default_factory=dict)
+    wakeups: set = field(default_factory=set)
 
 async def upload_photos(
     is_videos_only=False,
     is_missing_exif_only=False,
     is_uploading_all=False,
+    concurrency=None,
+    is_streaming=False,
 ):
-    """Uploads all photos and updates the entry files, printing output summaries throughout."""
+    """Uploads all photos and updates the entry files, printing output summaries throughout. Albums
+    are created as their first batches of photos are ready. If `is_streaming` is set, every photo is
+    streamed from Flickr, ignoring any downloaded files."""
 
-    requests = _get_requests(
+    filters = _get_pending_filters(
         is_videos_only,
         is_missing_exif_only,
         is_uploading_all,
     )
 
-    _print_init(requests)
+    _print_init(count_photos(**filters))
 
-    responses = []
+    # Copies of content that is uploaded in this run, or was by an earlier one, are not uploaded.
+    items, duplicates = partition_duplicates(
+        _iterate_items(filters),
+        is_using_index=not is_uploading_all,
+    )
 
-    # Handle requests in chunks due to the size of requests:
+    # Ensure that a token exists; it is then refreshed in-memory as it nears expiry.
+    authenticate_user()
 
-    for i in range(0, len(requests), REQUESTS_BATCH_SIZE):
-        authenticate_user()
+    # Byte uploads run in a concurrent worker pool, while batch item creations must be performed
+    # sequentially; connect the two with a bounded queue so that neither channel sits idle.
+    state = CommitState(asyncio.Queue(UPLOAD_QUEUE_SIZE))
+    num_reused = 0
 
-        # Batch item creations must be performed sequentially. Note that it is possible to run bytes upload
-        # jobs while these are pending, but skip this optimization for simplicity.
-        for request, _ in requests[i:i + REQUESTS_BATCH_SIZE]:
-            batch_response = await request
-            responses.append(batch_response)
-            _print_batch_summary(batch_response, responses)
+    def generate_items():
+        nonlocal num_reused
 
-    _print_summary(responses)
+        previous_directory = None
 
-    return _reduce_response_counts(responses)
+        for item in items:
+            directory, photo = item
 
-def _get_requests(
-    is_videos_only,
-    is_missing_exif_only,
-    is_uploading_all,
-):
-    """Returns a list of batch requests for all remaining photos."""
+            # Items are read a directory at a time, so the previous directory is now exhausted.
+            if previous_directory is not None and previous_directory != directory:
+                _exhaust_directory(state, previous_directory)
 
-    requests = []
+            if has_valid_upload_token(photo):
+                num_reused += 1
 
-    _, directories, _ = next(os.walk(get_outputs_path()))
+            state.num_unresolved[directory] += 1
+            previous_directory = directory
 
-    for directory in directories:
-        google_album_id = _read_google_album_id(directory)
+            yield item
 
-        assert google_album_id is not None or directory == 'photostream'
+        state.is_exhausted = True
 
-        photos = _get_pending_photos(
-            directory,
-            is_videos_only,
-            is_missing_exif_only,
-            is_uploading_all,
+        if previous_directory is not None:
+            _exhaust_directory(state, previous_directory)
+
+    async def upload_item_bytes(item):
+        directory, photo = item
+
+        # Skip straight to item creation for bytes uploaded by an earlier attempt or run.
+        if has_valid_upload_token(photo):
+            return photo
+
+        photo = await upload_bytes(
+            photo,
+            lambda: write_photo_data(directory, photo),
+            is_streaming,
         )
 
-        for i in range(0, len(photos), CONTENT_BATCH_LIMIT):
-            batch = photos[i: i + CONTENT_BATCH_LIMIT]
-            request = _upload_photo_batch(
-                directory,
-                google_album_id,
-                batch,
-            )
+        # Persist the token so that a failed item creation can be retried without the bytes.
+        write_photo_data(directory, photo)
+
+        return photo
+
+    async def on_bytes_uploaded(entry, _):
+        directory, _ = entry.item
+        await state.commit_queue.put((directory, entry))
+
+    def on_parked(entry):
+        directory, _ = entry.item
+        state.num_unresolved[directory] -= 1
+
+        _wake_committer(state, directory)
+
+    retry_queue = RetryQueue(
+        upload_item_bytes,
+        concurrency or UPLOAD_WORKERS,
+        on_result=on_bytes_uploaded,
+        on_parked=on_parked,
+    )
+
+    committer = asyncio.create_task(_run_committer(state, retry_queue))
+    run = asyncio.create_task(retry_queue.run(generate_items()))
+
+    try:
+        await asyncio.wait([run, committer], return_when=asyncio.FIRST_COMPLETED)
+
+        # The committer only returns once told to, so if it has finished, it has failed; raise
+        # rather than wait on entries that can no longer be resolved.
+        if committer.done():
+            committer.result()
 
-            # Add the batch size for logging.
-            requests.append((request, len(batch)))
+        counts = run.result()
 
-    return requests
+        await state.commit_queue.put(None)
+        await committer
+    finally:
+        run.cancel()
+        committer.cancel()
 
-def _get_pending_photos(
-    directory,
+    _print_summary(counts, retry_queue, num_reused, len(duplicates))
+
+    num_attached, num_attached_attempted = await attach_duplicates(duplicates)
+
+    # Photos in several albums are uploaded into one, then added to the others.
+    await add_photos_to_albums()
+
+    succeeded_count, attempted_count = counts
+
+    return succeeded_count + num_attached, attempted_count + num_attached_attempted
+
+def _get_pending_filters(
     is_videos_only,
     is_missing_exif_only,
     is_uploading_all,
 ):
-    """Returns a list of photos to be uploaded within `directory`."""
+    """Returns the directory filters that match all photos to be uploaded."""
 
-    photos = []
+    # Ignore photos that were not properly fetched:
+    return {
+        'is_populated': True,
+        'is_uploaded': None if is_uploading_all else False,
+        'is_video': True if is_videos_only else None,
+        'did_update_exif': True if is_missing_exif_only else None,
+    }
 
-    _, _, filenames = next(os.walk(get_directory_path(directory)))
+def _iterate_items(filters):
+    """Yields `(directory, photo)` items for the photos matching `filters`, a directory at a time."""
 
-    for filename in filenames:
-        if filename == 'metadata.json':
-            continue
+    for directory in read_directories():
+        yield from iterate_photos(directory=directory, **filters)
 
-        photo = read_photo_data(directory, filename)
+def _wake_committer(state, directory):
+    """Sends the committer a message to reconsider the batch for `directory`, without blocking, as
+    the caller may itself be resolving an entry."""
 
-        if PhotoEntryKeys.GOOGLE_MEDIA_ID in photo and not is_uploading_all:
-            continue
+    wakeup = asyncio.create_task(state.commit_queue.put((directory, None)))
+    state.wakeups.add(wakeup)
+    wakeup.add_done_callback(state.wakeups.discard)
 
-        if is_videos_only and not _is_media_video(photo):
-            continue
+def _exhaust_directory(state, directory):
+    """Records that every item in `directory` has been read."""
 
-        if is_missing_exif_only and PhotoEntryKeys.DID_UPDATE_EXIF not in photo:
-            continue
+    state.exhausted_directories.add(directory)
+    _wake_committer(state, directory)
 
-        # Ignore photos that were not properly fetched:
-        if len(photo.keys()) <= 1:
-            continue
+async def _run_committer(state, retry_queue):
+    """Creates media items for the entries from the commit queue until a `None` message is received.
+    Full batches are committed into the album of their directory, waiting for it to be created
+    without holding up other directories. Once a directory is exhausted and every unresolved item in
+    it has arrived, its remaining partial batch is packed with those of other directories, and the
+    packed batches are committed without an album."""
 
-        photos.append(photo)
+    batches = {}
+    packed_batch = []
 
-    return photos
+    while (message := await state.commit_queue.get()) is not None:
+        directory, entry = message
 
-async def _upload_photo_batch(directory, album_id, batch):
-    """Uploads photo bytes and bodies for `batch` then updates the corresponding data entries."""
+        if entry is not None:
+            batches.setdefault(directory, []).append(entry)
 
-    uploaded_batch = await upload_bytes_batch(batch)
-    photos = await upload_content_batch(uploaded_batch, album_id)
+        batch = batches.get(directory, [])
 
-    for photo in photos:
-        write_photo_data(directory, photo)
+        while len(batch) >= CONTENT_BATCH_LIMIT:
+            album_task = _get_album_task(state, directory)
 
-    return (len(photos), len(batch))
+            if album_task is not None and not album_task.done():
+                break
 
-def _is_media_video(photo):
-    """Returns a boolean indicating whether the media item is a video."""
+            committed_batch, batch = batch[:CONTENT_BATCH_LIMIT], batch[CONTENT_BATCH_LIMIT:]
 
-    return photo['media'] == 'video'
+            await _commit_batch(committed_batch, album_task, retry_queue, state)
 
-def _reduce_response_counts(responses):
-    """Reduces a list of proportion tuples to a single cumulative value."""
+        is_complete = _is_directory_complete(state, directory, batch, packed_batch)
 
-    return reduce(lambda x, y: (x[0] + y[0], x[1] + y[1]), responses, (0, 0))
+        if is_complete and len(batch) < CONTENT_BATCH_LIMIT:
+            packed_batch += batch
+            batch = []
 
-def _print_init(requests):
-    """Prints an upload initiation message."""
+        batches[directory] = batch
+
+        while _is_packed_batch_ready(state, packed_batch):
+            committed_batch = packed_batch[:CONTENT_BATCH_LIMIT]
+            packed_batch = packed_batch[CONTENT_BATCH_LIMIT:]
+
+            await _commit_batch(committed_batch, None, retry_queue, state)
+
+def _is_directory_complete(state, directory, batch, packed_batch):
+    """Returns a boolean indicating whether `batch`, together with the entries of its directory that
+    are packed already, holds every unresolved item of its exhausted directory, so that no other item
+    can join it. Packed entries are counted, as retries may return after their siblings were packed."""
+
+    num_packed = sum(1 for entry in packed_batch if entry.item[0] == directory)
+
+    return (
+        len(batch) > 0
+        and directory in state.exhausted_directories
+        and len(batch) + num_packed >= state.num_unresolved[directory]
+    )
+
+def _is_packed_batch_ready(state, packed_batch):
+    """Returns a boolean indicating whether `packed_batch` is full, or holds every unresolved item
+    once all items have been read."""
+
+    if len(packed_batch) == 0:
+        return False
+
+    is_complete = (
+        state.is_exhausted
+        and len(packed_batch) >= sum(state.num_unresolved.values())
+    )
 
-    num_photos = _parse_num_photos(requests)
+    return len(packed_batch) >= CONTENT_BATCH_LIMIT or is_complete
+
+def _get_album_task(state, directory):
+    """Returns the task creating the album for `directory`, starting it when first needed, or `None`
+    for the photostream. The committer is woken once the task is done."""
+
+    if directory == PHOTOSTREAM_DIRECTORY:
+        return None
+
+    album_task = state.album_tasks.get(directory, None)
+
+    if album_task is None:
+        album_task = start_album_creation(directory)
+        album_task.add_done_callback(lambda _: _wake_committer(state, directory))
+
+        state.album_tasks[directory] = album_task
+
+    return album_task
+
+async def _commit_batch(batch, album_task, retry_queue, state):
+    """Creates media items for the entries in `batch`, in the album created by `album_task` if set,
+    then updates the corresponding data entries and resolves each entry in `retry_queue`. Without an
+    album task, items outside the photostream are marked to be added to their albums afterwards."""
+
+    photos = [entry.item[1] for entry in batch]
+
+    try:
+        album_id = None if album_task is None else album_task.result()
+        uploaded_photos = await upload_content_batch(photos, album_id)
+    except Exception as err:
+        # Forget a failed album creation, so that it is retried with the batch.
+        if album_task is not None and album_task.exception() is not None:
+            del state.album_tasks[batch[0].item[0]]
+
+        for entry in batch:
+            retry_queue.fail(entry, err)
+
+        _print_batch_summary((0, len(batch)))
+        return
+
+    uploaded_ids = set(photo['id'] for photo in uploaded_photos)
+    directories = {}
+
+    for directory, photo in (entry.item for entry in batch):
+        # Tokens are consumed on creation; those rejected individually are likely invalid, so the
+        # bytes are uploaded again on retry.
+        clear_upload_token(photo)
+
+        if photo['id'] in uploaded_ids:
+            _record_album_placement(directory, photo, album_task is not None)
+
+        directories.setdefault(directory, []).append(photo)
+
+    for directory, directory_photos in directories.items():
+        write_photos_data(directory, directory_photos)
+
+    index_uploaded_photos(uploaded_photos)
+
+    for entry in batch:
+        directory, photo = entry.item
+
+        if photo['id'] in uploaded_ids:
+            state.num_unresolved[directory] -= 1
+            retry_queue.succeed(entry, photo)
+        else:
+            retry_queue.fail(entry, TransientError('Media item was not created'))
+
+    _print_batch_summary((len(uploaded_photos), len(batch)))
+
+def _record_album_placement(directory, photo, is_in_album):
+    """Records whether the media item for `photo` was created in the album of its directory, so that
+    items created without it are added to the album afterwards."""
+
+    if is_in_album or directory == PHOTOSTREAM_DIRECTORY:
+        photo.pop(PhotoEntryKeys.GOOGLE_CREATED_WITHOUT_ALBUM, None)
+    else:
+        photo[PhotoEntryKeys.GOOGLE_CREATED_WITHOUT_ALBUM] = True
+
+def _print_init(num_pending):
+    """Prints an upload initiation message."""
 
     print_separator()
     print_timestamped(
-        'Beginning upload for {} remaining photo(s).'.format(num_photos)
+        'Beginning upload for {} remaining photo(s).'.format(num_pending)
     )
 
-def _print_batch_summary(batch_response, responses):
+def _print_batch_summary(batch_response):
     """Prints an intermediate upload summary."""
 
     batch_succeeded_count, batch_attempted_count = batch_response
@@ -168,27 +360,19 @@ def _print_batch_summary(batch_response, responses):
 
     print_timestamped(content)
 
-def _print_summary(responses):
+def _print_summary(counts, retry_queue, num_reused, num_duplicates):
     """Prints a final upload summary."""
 
-    succeeded_count, attempted_count = _reduce_response_counts(responses)
+    succeeded_count, attempted_count = counts
 
     print_separator()
+    retry_queue.print_dead_letters(lambda item: 'photo {}'.format(item[1]['id']))
     print_timestamped(
-        f'Uploaded {succeeded_count} out of {attempted_count} remaining photo(s).'
+        f'Uploaded {succeeded_count} out of {attempted_count} remaining photo(s), '
+        f'reusing upload tokens for {num_reused}.'
+    )
+    print_timestamped(
+        'Skipped {} duplicate photo(s), to be added as items already uploaded.'.format(
+            num_duplicates,
+        )
     )
-
-def _parse_num_photos(requests):
-    """Returns the number of photos in `requests` for logging."""
-
-    return sum([batch_size for _, batch_size in requests])
-
-def _read_google_album_id(directory):
-    """Returns the Google Photos album ID for the album at `album_path`."""
-
-    if directory == 'photostream':
-        return None
-
-    metadata = read_album_metadata(directory)
-    return metadata.get(PhotoEntryKeys.GOOGLE_ALBUM_ID, None)
-
@@ -1,11 +1,108 @@
 import json
+import datetime
 import httpx
 
-from .config import read_oauth_token
+from .authenticate import read_credentials, refresh_credentials
+from .constants import (
+    Endpoints,
+    MAX_CONNECTIONS,
+    MAX_KEEPALIVE_CONNECTIONS,
+    KEEPALIVE_EXPIRY_SECONDS,
+    REQUEST_TIMEOUT_SECONDS,
+    TOKEN_REFRESH_MARGIN_SECONDS,
+    API_REQUESTS_PER_SECOND,
+    API_REQUESTS_BURST,
+    API_DAILY_QUOTA,
+    UPLOAD_REQUESTS_PER_SECOND,
+    UPLOAD_REQUESTS_BURST,
+)
+from common.rate_limit import RateLimiter, THROTTLING_STATUS_CODES, parse_retry_after
 
 # TODO: Nice-looking download progress bars:
 # https://www.python-httpx.org/advanced/clients/
 
+client = None
+client_options = {
+    'max_connections': MAX_CONNECTIONS,
+    'is_http2': False,
+}
+
+credentials = None
+
+# Byte uploads are limited separately from the other API requests, and do not count against the
+# daily quota.
+api_rate_limiter = RateLimiter(
+    'google-api',
+    API_REQUESTS_PER_SECOND,
+    API_REQUESTS_BURST,
+    API_DAILY_QUOTA,
+)
+upload_rate_limiter = RateLimiter(
+    'google-uploads',
+    UPLOAD_REQUESTS_PER_SECOND,
+    UPLOAD_REQUESTS_BURST,
+)
+
+def configure_client(max_connections=None, is_http2=None):
+    """Sets the connection options for the shared client, which must be called before its first use."""
+
+    assert client is None
+
+    if max_connections is not None:
+        client_options['max_connections'] = max_connections
+
+    if is_http2 is not None:
+        client_options['is_http2'] = is_http2
+
+def configure_rate_limits(rate=None, daily_quota=None):
+    """Sets the maximum number of requests per second for each endpoint, and the daily quota of API
+    requests other than byte uploads."""
+
+    api_rate_limiter.configure(rate=rate, daily_quota=daily_quota)
+    upload_rate_limiter.configure(rate=rate)
+
+def get_rate_limiter(url):
+    """Returns the rate limiter for requests to `url`."""
+
+    # Resumable upload sessions are addressed by URLs beneath the uploads endpoint.
+    if str(url).startswith(Endpoints.BYTE_UPLOADS):
+        return upload_rate_limiter
+
+    return api_rate_limiter
+
+def get_client():
+    """Returns the shared, pooled client, creating it on first use."""
+
+    global client
+
+    if client is None:
+        max_connections = client_options['max_connections']
+
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=min(max_connections, MAX_KEEPALIVE_CONNECTIONS),
+            keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS,
+        )
+
+        client = httpx.AsyncClient(
+            http2=client_options['is_http2'],
+            limits=limits,
+            timeout=REQUEST_TIMEOUT_SECONDS,
+        )
+
+    return client
+
+async def close_client():
+    """Closes the shared client, if open, and writes the usage counted against the daily quota."""
+
+    global client
+
+    api_rate_limiter.save_quota_usage()
+
+    if client is not None:
+        await client.aclose()
+        client = None
+
 async def post(url, headers=None, **kwargs):
     """Sends a POST request to `url` with the given parameters."""
 
@@ -34,23 +131,57 @@ def create_headers(**kwargs):
     return headers
 
 def _read_oauth_token():
-    """Returns the cached OAuth token."""
+    """Returns the in-memory OAuth token, refreshing it only when it is close to expiry."""
+
+    global credentials
+
+    if credentials is None:
+        credentials = read_credentials()
+
+    if _is_token_expiring(credentials):
+        refresh_credentials(credentials)
+
+    return credentials.token
 
-    token = read_oauth_token()
-    return token['token']
+def _is_token_expiring(creds):
+    """Returns a boolean indicating whether `creds` expires within the refresh margin."""
+
+    if creds.token is None:
+        return True
+
+    if creds.expiry is None:
+        return False
+
+    # Credential expiries are naive UTC datetimes.
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    margin = datetime.timedelta(seconds=TOKEN_REFRESH_MARGIN_SECONDS)
+
+    return creds.expiry - now < margin
 
 async def _send_request(method, url, headers, **kwargs):
-    """Sends an authenticated request and returns the response."""
+    """Sends an authenticated request once permitted by the endpoint's rate limiter, and returns
+    the response."""
 
-    request = httpx.Request(
+    client = get_client()
+    rate_limiter = get_rate_limiter(url)
+
+    request = client.build_request(
         method,
         url,
         headers=headers,
         **kwargs
     )
 
+    await rate_limiter.acquire()
+
     try:
-        async with httpx.AsyncClient() as client:
-            return await client.send(request)
+        response = await client.send(request)
     except Exception:
         return None
+
+    if response.status_code in THROTTLING_STATUS_CODES:
+        rate_limiter.on_throttled(parse_retry_after(response))
+    else:
+        rate_limiter.on_success()
+
+    return response
@@ -10,6 +10,7 @@ class Methods(StrEnum):
     DOWNLOAD_PHOTOS = 'download-photos'
     CREATE_ALBUMS = 'create-albums'
     UPLOAD_PHOTOS = 'upload-photos'
+    TRANSFER = 'transfer'
 
 parser = argparse.ArgumentParser(
     prog='Flickr-To-Google',
@@ -36,3 +37,25 @@ parser.add_argument('-v', '--videos-only', action=argparse.BooleanOptionalAction
 # re-upload to Google Photos. While it is possible to re-upload all photos, this reduces the
 # downloading required (as a download is required to check the image's metadata).
 parser.add_argument('-e', '--missing-exif-only', action=argparse.BooleanOptionalAction)
+
+# Adds only the photos uploaded, and the albums changed, since the directory was last created.
+parser.add_argument('--incremental', action=argparse.BooleanOptionalAction)
+
+# These configure the shared connection pool used for Google Photos requests.
+parser.add_argument('--max-connections', type=int)
+parser.add_argument('--http2', action=argparse.BooleanOptionalAction)
+
+# Limits the bytes held by concurrent downloads, EXIF updates and uploads at any time.
+parser.add_argument('--max-inflight-bytes', type=int)
+
+# Sets the number of concurrent requests for the phase being run.
+parser.add_argument('-c', '--concurrency', type=int)
+
+# Sets the maximum requests per second to Flickr and Google Photos, and the daily quota of Google
+# Photos API requests; requests slow down further when either service reports throttling.
+parser.add_argument('--flickr-rate', type=float)
+parser.add_argument('--google-rate', type=float)
+parser.add_argument('--google-daily-quota', type=int)
+
+# Sets the number of processes used for CPU-bound image work, such as EXIF updates.
+parser.add_argument('--processes', type=int)
@@ -0,0 +1,21 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# Modules are imported relative to the package directory, as when run with `python3 flickr-to-google`.
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import common.directory
+
+@pytest.fixture
+def directory(tmp_path, monkeypatch):
+    """Points the directory database at a temporary home for the duration of a test."""
+
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setattr(common.directory, 'connection', None)
+
+    yield
+
+    if common.directory.connection is not None:
+        common.directory.connection.close()
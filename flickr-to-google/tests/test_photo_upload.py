@@ -0,0 +1,84 @@
+import time
+import sqlite3
+import asyncio
+
+import pytest
+
+import common.retry
+import google.photo_upload as photo_upload
+from common.directory import count_photos, write_album_metadata, write_photos_data
+
+# Fail the upload well before any real retry delay would elapse:
+TIMEOUT_SECONDS = 10
+
+def create_photo(photo_id):
+    return {'id': photo_id, 'url': 'url', 'media': 'photo', 'title': 'title', 'description': ''}
+
+def patch_uploads(monkeypatch, create_batch):
+    """Replaces the network calls of the upload pipeline, creating items with `create_batch`."""
+
+    async def upload_bytes(photo, checkpoint_handler=None, is_streaming=False):
+        photo['google-upload-token'] = 'token-' + photo['id']
+        photo['google-upload-token-issued'] = time.time()
+        return photo
+
+    async def attach_duplicates(duplicates):
+        return 0, 0
+
+    async def add_photos_to_albums():
+        return 0, 0
+
+    monkeypatch.setattr(common.retry, 'get_retry_delay', lambda attempts: 0)
+    monkeypatch.setattr(photo_upload, 'authenticate_user', lambda: None)
+    monkeypatch.setattr(photo_upload, 'upload_bytes', upload_bytes)
+    monkeypatch.setattr(photo_upload, 'upload_content_batch', create_batch)
+    monkeypatch.setattr(photo_upload, 'attach_duplicates', attach_duplicates)
+    monkeypatch.setattr(photo_upload, 'add_photos_to_albums', add_photos_to_albums)
+
+def test_retries_items_failed_in_packed_batch(directory, monkeypatch):
+    # The first packed batch holds all of the first album and half of the second.
+    write_album_metadata({'id': 'album-0', 'title': 'album-0'})
+    write_photos_data('album-0', [create_photo(f'album-0-{i:02d}') for i in range(45)])
+
+    write_album_metadata({'id': 'album-1', 'title': 'album-1'})
+    write_photos_data('album-1', [create_photo(f'album-1-{i:02d}') for i in range(10)])
+
+    num_batches = 0
+
+    async def create_batch(photos, album_id):
+        nonlocal num_batches
+        num_batches += 1
+
+        # Reject the second album's items in the first batch, while their siblings remain packed.
+        if num_batches == 1:
+            photos = [photo for photo in photos if not photo['id'].startswith('album-1')]
+
+        for photo in photos:
+            photo['google-media-id'] = 'media-' + photo['id']
+
+        return photos
+
+    patch_uploads(monkeypatch, create_batch)
+
+    counts = asyncio.run(asyncio.wait_for(photo_upload.upload_photos(), TIMEOUT_SECONDS))
+
+    assert counts == (55, 55)
+    assert count_photos(is_uploaded=False) == 0
+
+def test_raises_when_committer_fails(directory, monkeypatch):
+    write_photos_data('photostream', [create_photo(f'photostream-{i:02d}') for i in range(5)])
+
+    async def create_batch(photos, album_id):
+        for photo in photos:
+            photo['google-media-id'] = 'media-' + photo['id']
+
+        return photos
+
+    def fail_write(directory, photos):
+        raise sqlite3.OperationalError('database is locked')
+
+    patch_uploads(monkeypatch, create_batch)
+    monkeypatch.setattr(photo_upload, 'write_photos_data', fail_write)
+
+    with pytest.raises(sqlite3.OperationalError):
+        asyncio.run(asyncio.wait_for(photo_upload.upload_photos(), TIMEOUT_SECONDS))